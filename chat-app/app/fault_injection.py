@@ -0,0 +1,89 @@
+"""
+Local fault-injecting stub of a model API, to check how the resilience layer behaves
+under transient errors, tail latency and outages without calling the real API.
+
+Usage:
+    python app/fault_injection.py
+"""
+import asyncio
+import random
+
+from google.api_core import exceptions as api_exceptions
+
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+
+class FaultInjectingStub:
+    """
+    Fake upstream API: answers after latency seconds, fails with error_rate probability
+    and is slow (slow_latency seconds) with slow_rate probability. Set down to simulate an outage.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 1.0,
+        error: Exception = api_exceptions.ServiceUnavailable("injected fault"),
+        seed: int = 42,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error = error
+        self.down = False
+        self.requests = 0
+        self._random = random.Random(seed)
+
+    async def send_message(self, message: str) -> str:
+        self.requests += 1
+        if self.down:
+            raise self.error
+        slow = self._random.random() < self.slow_rate
+        await asyncio.sleep(self.slow_latency if slow else self.latency)
+        if self._random.random() < self.error_rate:
+            raise self.error
+        return f"echo: {message}"
+
+
+async def run_requests(caller: ResilientCaller, stub: FaultInjectingStub, num_requests: int):
+    errors = 0
+    for i in range(num_requests):
+        try:
+            await caller.call(lambda: stub.send_message(f"message {i}"))
+        except (CircuitOpenError, api_exceptions.GoogleAPICallError):
+            errors += 1
+    return errors
+
+
+async def main():
+    print("transient errors (20% of the requests fail)")
+    stub = FaultInjectingStub(error_rate=0.2)
+    caller = ResilientCaller("stub", base_delay=0.01)
+    errors = await run_requests(caller, stub, 100)
+    print(f"  errors: {errors}, upstream requests: {stub.requests}, metrics: {caller.snapshot()}")
+
+    print("tail latency (5% of the requests take 1s), with hedging")
+    stub = FaultInjectingStub(slow_rate=0.05)
+    caller = ResilientCaller("stub", hedge=True)
+    start = asyncio.get_running_loop().time()
+    await run_requests(caller, stub, 100)
+    elapsed = asyncio.get_running_loop().time() - start
+    print(f"  elapsed: {elapsed:.2f}s, upstream requests: {stub.requests}, metrics: {caller.snapshot()}")
+
+    print("outage, with circuit breaker")
+    stub = FaultInjectingStub()
+    stub.down = True
+    caller = ResilientCaller("stub", base_delay=0.01, breaker=CircuitBreaker(failure_threshold=5, reset_timeout=0.5))
+    errors = await run_requests(caller, stub, 50)
+    print(f"  errors: {errors}, upstream requests: {stub.requests}, metrics: {caller.snapshot()}")
+    stub.down = False
+    await asyncio.sleep(0.5)
+    errors = await run_requests(caller, stub, 10)
+    print(f"  after recovery, errors: {errors}, metrics: {caller.snapshot()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+import asyncio
+import codecs
+import os
+import typing
+from dataclasses import dataclass
+
+READ_FILE_MAX_BYTES = int(os.environ.get("READ_FILE_MAX_BYTES", 256 * 1024))
+READ_FILE_CHUNK_SIZE = int(os.environ.get("READ_FILE_CHUNK_SIZE", 16 * 1024))
+# max number of bytes of a read sent back to the model, the rest is only streamed to the UI
+READ_FILE_PAGE_BYTES = int(os.environ.get("READ_FILE_PAGE_BYTES", 4 * 1024))
+# number of bytes inspected to decide whether a file is binary
+BINARY_SNIFF_SIZE = 8 * 1024
+
+
+class BinaryFileError(ValueError):
+    """
+    Raised when trying to read a binary file as text.
+    """
+
+
+@dataclass
+class FileSlice:
+    path: str
+    size: int
+    start: int
+    end: int
+
+    @property
+    def truncated(self) -> bool:
+        """
+        True if the slice doesn't cover the whole file.
+        """
+        return self.start > 0 or self.end < self.size
+
+
+def is_binary(path: str) -> bool:
+    """
+    Check whether a file is binary by looking only at its first bytes:
+    a NUL byte or invalid UTF-8 means it is not a text file.
+    """
+    with open(path, "rb") as f:
+        head = f.read(BINARY_SNIFF_SIZE)
+    if b"\x00" in head:
+        return True
+    try:
+        # final=False, the sniffed block may end in the middle of a multibyte character
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def plan_read(
+    path: str,
+    offset: int = 0,
+    length: typing.Optional[int] = None,
+    tail: bool = False,
+    max_bytes: int = READ_FILE_MAX_BYTES,
+) -> FileSlice:
+    """
+    Work out which bytes of the file to read, capped to max_bytes.
+    :param path: path of the file
+    :param offset: byte offset where to start reading, ignored in tail mode
+    :param length: number of bytes to read, the whole file (up to max_bytes) by default
+    :param tail: read the last length bytes of the file
+    :param max_bytes: max number of bytes to read
+    :return: the slice of the file to read
+    Raises:
+        FileNotFoundError: If the file doesn't exist.
+        BinaryFileError: If the file is binary.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"File {path} not found.")
+    if is_binary(path):
+        raise BinaryFileError(f"File {path} is a binary file.")
+    size = os.path.getsize(path)
+    length = max_bytes if length is None else max(0, min(int(length), max_bytes))
+    if tail:
+        start = max(0, size - length)
+    else:
+        start = min(max(0, int(offset)), size)
+    end = min(size, start + length)
+    return FileSlice(path, size, start, end)
+
+
+async def read_chunks(
+    file_slice: FileSlice, chunk_size: int = READ_FILE_CHUNK_SIZE
+) -> typing.AsyncIterator[str]:
+    """
+    Read a slice of a text file chunk by chunk, without blocking the event loop.
+    :param file_slice: the slice of the file to read
+    :param chunk_size: number of bytes read at a time
+    :return: async iterator over the decoded chunks
+    """
+    # multibyte characters may be split between chunks, the incremental decoder takes care of them
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    f = await asyncio.to_thread(open, file_slice.path, "rb")
+    try:
+        await asyncio.to_thread(f.seek, file_slice.start)
+        remaining = file_slice.end - file_slice.start
+        while remaining > 0:
+            data = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            text = decoder.decode(data, final=remaining <= 0)
+            if text:
+                yield text
+    finally:
+        await asyncio.to_thread(f.close)
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import typing
+
+from vertexai.generative_models import Content, GenerativeModel, Part
+
+from resilience import ResilientCaller
+
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", 6))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 8000))
+# seconds before a summary request is abandoned, a hung request would block all the next summaries
+HISTORY_SUMMARY_TIMEOUT = float(os.environ.get("HISTORY_SUMMARY_TIMEOUT", 60))
+# Gemini bills a fixed number of tokens per image, whatever its size
+IMAGE_TOKENS = 258
+
+SUMMARY_PROMPT = (
+    "You are summarizing a conversation between a user and a chatbot so it can be continued later.\n"
+    "Update the current summary with the new messages. Keep names, facts, decisions and open questions, "
+    "drop greetings and small talk. Answer only with the updated summary.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New messages:\n{transcript}"
+)
+SUMMARY_CONTEXT = "Summary of the earlier conversation:\n{summary}"
+
+Turn = typing.List[Content]
+
+
+def estimate_tokens(contents: typing.List[typing.Any]) -> int:
+    """
+    Cheap local estimate of the number of tokens of a request (~4 characters per token),
+    good enough to enforce the budget without an extra round trip to count_tokens.
+    :param contents: list of Content, Part or str
+    :return: estimated number of tokens
+    """
+    tokens = 0
+    for content in contents:
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        parts = content.parts if isinstance(content, Content) else [content]
+        for part in parts:
+            part_dict = part.to_dict()
+            if "inline_data" in part_dict or "file_data" in part_dict:
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += len(json.dumps(part_dict)) // 4
+    return tokens
+
+
+def turn_to_text(turn: Turn) -> str:
+    """
+    Render a turn as plain text, so it can be included in the summarization prompt.
+    """
+    lines = []
+    for content in turn:
+        for part in content.parts:
+            part_dict = part.to_dict()
+            if "text" in part_dict:
+                lines.append(f"{content.role}: {part_dict['text']}")
+            elif "function_call" in part_dict:
+                lines.append(f"{content.role}: called the tool {part_dict['function_call'].get('name')}")
+            elif "function_response" in part_dict:
+                lines.append(f"{content.role}: returned the result of a tool call")
+            elif "inline_data" in part_dict or "file_data" in part_dict:
+                lines.append(f"{content.role}: [image]")
+    return "\n".join(lines)
+
+
+class ChatHistoryManager:
+    """
+    Keeps the history sent to the model bounded: the last max_turns turns are sent verbatim,
+    older turns are folded into a rolling summary in the background, and every request
+    is trimmed to fit in token_budget.
+    A turn is a user message plus everything that follows it (model answer, tool calls and tool results).
+    """
+
+    def __init__(
+        self,
+        model: GenerativeModel,
+        summarizer: GenerativeModel = None,
+        max_turns: int = HISTORY_MAX_TURNS,
+        token_budget: int = HISTORY_TOKEN_BUDGET,
+        resilience: ResilientCaller = None,
+        summary_timeout: float = HISTORY_SUMMARY_TIMEOUT,
+    ):
+        self.model = model
+        self.resilience = resilience
+        self.summary_timeout = summary_timeout
+        self.summarizer = summarizer or model
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.turns: typing.List[Turn] = []
+        self.summary = ""
+        self.prompt_tokens: typing.List[int] = []
+        # turns evicted from the window that are not part of the summary yet
+        self._pending: typing.List[Turn] = []
+        self._summary_task: typing.Optional[asyncio.Task] = None
+
+    def _summary_contents(self) -> typing.List[Content]:
+        if not self.summary:
+            return []
+        return [
+            Content(role="user", parts=[Part.from_text(SUMMARY_CONTEXT.format(summary=self.summary))]),
+            Content(role="model", parts=[Part.from_text("Understood, I will keep it in mind.")]),
+        ]
+
+    def _build_history(self, message: typing.Any, new_turn: bool) -> typing.List[Content]:
+        """
+        Build the history for the next request, dropping the oldest turns until it fits in the budget.
+        """
+        message = message if isinstance(message, list) else [message]
+        summary = self._summary_contents()
+        turns = self._pending + self.turns
+        # the turn in progress (waiting for a tool result) can't be dropped
+        min_turns = 0 if new_turn else 1
+        used = estimate_tokens(summary) + estimate_tokens(message)
+        turns_tokens = [estimate_tokens(turn) for turn in turns]
+        while len(turns) > min_turns and used + sum(turns_tokens) > self.token_budget:
+            dropped = turns.pop(0)
+            turns_tokens.pop(0)
+            # make sure turns that don't fit anymore end up in the summary
+            if self.turns and dropped is self.turns[0]:
+                self._pending.append(self.turns.pop(0))
+        history = list(summary)
+        for turn in turns:
+            history.extend(turn)
+        return history
+
+    def _schedule_summary(self):
+        if self._pending and (self._summary_task is None or self._summary_task.done()):
+            self._summary_task = asyncio.create_task(self._summarize())
+
+    async def _summarize(self):
+        """
+        Fold the pending turns into the rolling summary. Runs in the background,
+        so the user never waits for it.
+        """
+        while self._pending:
+            batch = list(self._pending)
+            transcript = "\n".join(turn_to_text(turn) for turn in batch)
+            prompt = SUMMARY_PROMPT.format(summary=self.summary or "(empty)", transcript=transcript)
+            try:
+                response = await asyncio.wait_for(
+                    self.summarizer.generate_content_async(prompt), timeout=self.summary_timeout
+                )
+                self.summary = response.text.strip()
+            except asyncio.TimeoutError:
+                print(f"Summarizing the chat history timed out after {self.summary_timeout}s")
+                return
+            except Exception as e:
+                # keep the turns as pending, we will try again after the next turn
+                print(f"Failed to summarize the chat history: {e}")
+                return
+            del self._pending[: len(batch)]
+
+    async def send_message(self, message: typing.Any, tools: typing.List[typing.Any] = None):
+        """
+        Send a message to the model with the bounded history.
+        :param message: the message, a string, a Part or a list of them
+        :param tools: tools available to the model
+        :return: the model response
+        """
+        new_turn = not self._is_function_response(message)
+        history = self._build_history(message, new_turn)
+
+        async def attempt():
+            # a new chat session per attempt, so retries and hedged requests don't share state
+            # the session appends to the list it is given, pass a copy so history stays the sent context
+            chat_session = self.model.start_chat(history=list(history))
+            response = await chat_session.send_message_async(message, tools=tools)
+            return chat_session, response
+
+        if self.resilience is not None:
+            chat_session, response = await self.resilience.call(attempt)
+        else:
+            chat_session, response = await attempt()
+
+        new_contents = chat_session.history[len(history):]
+        if new_turn or not self.turns:
+            self.turns.append(new_contents)
+        else:
+            self.turns[-1].extend(new_contents)
+        while len(self.turns) > self.max_turns:
+            self._pending.append(self.turns.pop(0))
+        self._schedule_summary()
+
+        prompt_tokens = response.usage_metadata.prompt_token_count
+        self.prompt_tokens.append(prompt_tokens)
+        print(
+            f"prompt tokens: {prompt_tokens} "
+            f"(turns: {len(self.turns)}, pending: {len(self._pending)}, summary: {bool(self.summary)})"
+        )
+        return response
+
+    @staticmethod
+    def _is_function_response(message: typing.Any) -> bool:
+        parts = message if isinstance(message, list) else [message]
+        return any(isinstance(part, Part) and "function_response" in part.to_dict() for part in parts)
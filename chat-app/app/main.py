@@ -1,18 +1,23 @@
+import asyncio
 import os.path
+import uuid
 
 import chainlit as cl
 import vertexai
 from vertexai.generative_models import GenerativeModel
-from vertexai.generative_models import Image, Part, FunctionDeclaration, Tool
 from google.auth import default
 from google.oauth2 import service_account
 from google.auth.exceptions import DefaultCredentialsError
 from pathlib import Path
 from vertexai.preview.vision_models import ImageGenerationModel
-import tenacity
 import torch
 from diffusers import StableDiffusion3Pipeline
 from google.cloud import secretmanager
+from multimodal import ImageCache, load_image_parts
+from history import HISTORY_TOKEN_BUDGET, ChatHistoryManager
+from tools import ToolRegistry
+from resilience import DEFAULT_RETRYABLE_ERRORS, ResilientCaller
+from file_reader import READ_FILE_PAGE_BYTES, plan_read, read_chunks
 
 
 
@@ -27,6 +32,8 @@ system_message = (
 
 PROJECT_ID = "build-with-ai-project"
 LOCATION = "us-central1"
+# max number of times the model can call tools before answering
+MAX_TOOL_ROUNDS = 3
 
 def get_gcp_credentials(credentials_file=None):
     """
@@ -85,15 +92,25 @@ google_imagen = ImageGenerationModel.from_pretrained("imagen-3.0-generate-001")
 # stable_diffusion = StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers",torch_dtype=torch.float16)
 # image_gen_pipeline = stable_diffusion.to("mps")
 
+# shared by all the sessions, so the latency stats and the circuit breakers see all the traffic
+chat_resilience = ResilientCaller("gemini", timeout=60, hedge=os.environ.get("HEDGE_CHAT_REQUESTS", "0") == "1")
+# image generation is expensive, we retry it but never hedge it. A timed out attempt is not
+# retried: wait_for can't stop the thread running it, a retry would pay for a second generation
+imagen_resilience = ResilientCaller(
+    "imagen",
+    timeout=120,
+    max_attempts=2,
+    retryable_errors=tuple(error for error in DEFAULT_RETRYABLE_ERRORS if error is not asyncio.TimeoutError),
+)
+
 
 
-@tenacity.retry(wait=tenacity.wait_fixed(2), stop=tenacity.stop_after_attempt(3), reraise=True)
-async def send_chat_message(chat_session, message):
+async def send_chat_message(chat_history, message):
     """
-    Sends a chat message to the chatbot.
+    Sends a chat message to the chatbot, retries and hedging are handled by chat_resilience.
     """
     try:
-        response = await chat_session.send_message_async(message, tools=get_model_tools())
+        response = await chat_history.send_message(message, tools=get_model_tools())
         return response
     except Exception as e:
         raise RuntimeError(f"Failed to send chat message: {e}") from e
@@ -116,8 +133,10 @@ def generate_images_using_imagen(prompt: str, num_images: int):
                               person_generation="allow_adult",
                               add_watermark=True)
     files = []
+    # unique names, several generations can run at the same time
+    batch_id = uuid.uuid4().hex[:8]
     for i in range(int(num_images)):
-        image_path = images_folder / f"image_{i}.png"
+        image_path = images_folder / f"image_{batch_id}_{i}.png"
         generated_images[i].save(str(image_path))
         files.append(image_path)
     return files
@@ -147,42 +166,15 @@ def generate_images_using_stable_diff(prompt: str, num_images: int):
 
 
 
+tool_registry = ToolRegistry()
+
+
 def get_model_tools():
     """
-    Get the model tools.
+    Get the model tools, the function declarations are built once when the tools are registered.
     """
-    generate_images_tool = FunctionDeclaration(
-        name="generate_images",
-        description="Generate images based on a prompt.",
-        parameters={
-            "type": "object",
-            "properties": {
-                "prompt": {"type": "string"},
-                "num_images": {
-                    "type": "integer",
-                    "description": "The number of images to generate as int.",
-                },
-            },
-            "required": ["prompt"],
-        },
-    )
-    read_file = FunctionDeclaration(
-        name="read_file",
-        description="This function reads a file",
-        parameters={
-            "type": "object",
-            "properties": {
-                "path": {"type": "string"}
-            },
-            "required": ["path"],
-        },
-    )
-    # a tool is a collection of function declarations
-    return [
-         Tool(
-             function_declarations=[generate_images_tool, read_file]
-         )
-    ]
+    return tool_registry.model_tools
+
 
 @cl.step(type="tool")
 async def generate_image_tool(model, **function_args):
@@ -193,7 +185,9 @@ async def generate_image_tool(model, **function_args):
     :return:
     """
     if model == "imagen":
-        result = await cl.make_async(generate_images_using_imagen)(**function_args)
+        result = await imagen_resilience.call(
+            lambda: cl.make_async(generate_images_using_imagen)(**function_args)
+        )
     elif model == "stable_diff":
         result =  await cl.make_async(generate_images_using_stable_diff)(**function_args)
     else:
@@ -201,6 +195,100 @@ async def generate_image_tool(model, **function_args):
     return result
 
 
+@tool_registry.register(
+    name="generate_images",
+    description="Generate images based on a prompt.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "prompt": {"type": "string"},
+            "num_images": {
+                "type": "integer",
+                "description": "The number of images to generate as int.",
+            },
+        },
+        "required": ["prompt"],
+    },
+    timeout=300,
+)
+async def generate_images(prompt: str, num_images: int = 1):
+    """
+    Ask the user which model to use, generate the images and show them in the UI.
+    """
+    # the calls of a turn run concurrently but the UI shows one ask at a time, ask one after the other
+    async with cl.user_session.get("ask_lock"):
+        res = await cl.AskActionMessage(
+            content="Select a model to generate the image",
+            actions=[
+                cl.Action(name="imagen", value="imagen", label="Google Imagen"),
+                cl.Action(name="stable_diff", value="stable_diff", label="Stable Diffusion"),
+            ],
+        ).send()
+    if res is None:
+        return {"error": "The user did not select a model"}
+    model = res.get("value")
+    image_files = await generate_image_tool(model, prompt=prompt, num_images=num_images)
+    images = [cl.Image(path=str(file), display="inline") for file in image_files]
+    await cl.Message(content="Here are the generated images:", elements=images).send()
+    return {"files": [str(file) for file in image_files]}
+
+
+@tool_registry.register(
+    name="read_file",
+    description=(
+        "This function reads a text file. The file is shown to the user, and a page of it is returned: "
+        "if next_offset is set, call it again with that offset to read the rest, or use tail to read the end."
+    ),
+    parameters={
+        "type": "object",
+        "properties": {
+            "path": {"type": "string"},
+            "offset": {
+                "type": "integer",
+                "description": "Byte offset where to start reading, 0 by default.",
+            },
+            "length": {
+                "type": "integer",
+                "description": "Number of bytes to read.",
+            },
+            "tail": {
+                "type": "boolean",
+                "description": "Read the last bytes of the file, e.g. for log files.",
+            },
+        },
+        "required": ["path"],
+    },
+    timeout=30,
+)
+async def read_file(path: str, offset: int = 0, length: int = None, tail: bool = False):
+    """
+    Read a slice of a text file, streaming it to the UI chunk by chunk. Only the first page of
+    the slice (the last one in tail mode) is returned to the model, so a single read doesn't
+    blow the token budget of the history (~4 bytes per token, a page is at most a quarter of it).
+    """
+    file_slice = await asyncio.to_thread(plan_read, path, offset, length, tail)
+    message = cl.Message(content="")
+    async for chunk in read_chunks(file_slice):
+        await message.stream_token(chunk)
+    await message.send()
+
+    page_bytes = min(READ_FILE_PAGE_BYTES, HISTORY_TOKEN_BUDGET)
+    page_length = min(page_bytes, file_slice.end - file_slice.start)
+    if tail:
+        page = await asyncio.to_thread(plan_read, path, 0, page_length, True, page_bytes)
+    else:
+        page = await asyncio.to_thread(plan_read, path, file_slice.start, page_length, False, page_bytes)
+    content = "".join([chunk async for chunk in read_chunks(page)])
+    return {
+        "content": content,
+        "size": page.size,
+        "offset": page.start,
+        "end": page.end,
+        "next_offset": page.end if page.end < page.size else None,
+        "truncated": page.truncated,
+    }
+
+
 @cl.on_chat_start
 async def start():
     """
@@ -209,8 +297,12 @@ async def start():
     gemini = GenerativeModel(model_name="gemini-1.5-flash", 
                              system_instruction=system_message
                              )
-    chat_session = gemini.start_chat()
-    cl.user_session.set("chat_session", chat_session)
+    # the history manager keeps the context sent on every turn bounded
+    summarizer = GenerativeModel(model_name="gemini-1.5-flash")
+    chat_history = ChatHistoryManager(gemini, summarizer=summarizer, resilience=chat_resilience)
+    cl.user_session.set("chat_history", chat_history)
+    cl.user_session.set("image_cache", ImageCache())
+    cl.user_session.set("ask_lock", asyncio.Lock())
 
     message = cl.Message(content="Welcome to my chatbot!")
     await message.send() # send the message to the user/ui
@@ -220,48 +312,31 @@ async def message(new_incoming_message: cl.Message):
     """
     Handle messages from the user.
     """
-    # get the ref to the chat session
-    chat_session = cl.user_session.get("chat_session")
+    # get the ref to the chat history
+    chat_history = cl.user_session.get("chat_history")
 
     # create a multimodal prompt
     text_prompt = new_incoming_message.content
     message_elements = new_incoming_message.elements
     message_images = [element for element in message_elements if element.type == "image"]
-    images_parts = list(map(lambda x: Part.from_image(Image.load_from_file(x.path)), message_images))
+    image_cache = cl.user_session.get("image_cache")
+    images_parts = await load_image_parts([x.path for x in message_images], image_cache)
     multimodal_prompt = [text_prompt] + images_parts
 
     # send the multimodal prompt to the chat session, and get the response
-    response = await send_chat_message(chat_session, multimodal_prompt)
+    response = await send_chat_message(chat_history, multimodal_prompt)
     function_calls = response.candidates[0].function_calls
+    rounds = 0
+    while function_calls and rounds < MAX_TOOL_ROUNDS:
+        # run all the calls of the turn concurrently and send the results back in one message
+        print(f"function calls: {[function_call.name for function_call in function_calls]}")
+        function_responses = await tool_registry.execute(function_calls)
+        response = await send_chat_message(chat_history, function_responses)
+        function_calls = response.candidates[0].function_calls
+        rounds += 1
+
     if function_calls:
-        function_call = function_calls[0]
-        function_args = {
-            arg_name: arg_val for arg_name, arg_val in function_call.args.items()
-        }
-        print(function_call.name)
-        if function_call.name == "generate_images":
-            print("Generating images")
-            res = await cl.AskActionMessage(
-                content="Select a model to generate the image",
-                actions=[
-                    cl.Action(name="imagen", value="imagen", label="Google Imagen"),
-                    cl.Action(name="stable_diff", value="stable_diff", label="Stable Diffusion"),
-                ],
-            ).send()
-            model = res.get("value")
-            image_files = await generate_image_tool(model, **function_args)
-            images = []
-            for file in image_files:
-                image = cl.Image(path=str(file), display="inline")
-                images.append(image)
-            message = cl.Message(content="Here are the generated images:", elements=images)
-            await message.send()
-        elif function_call.name == "read_file":
-            path = function_args["path"]
-            with open(path, "r") as file:
-                content = file.read()
-            message = cl.Message(content=content)
-            await message.send()
+        message = cl.Message(content="Sorry, I could not complete your request.")
     else:
         message = cl.Message(content=response.text)
-        await message.send()
+    await message.send()
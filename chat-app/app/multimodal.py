@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import os
+import threading
+import typing
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image as PILImage
+from PIL import ImageOps
+from vertexai.generative_models import Part
+
+MAX_IMAGE_DIMENSION = int(os.environ.get("MAX_IMAGE_DIMENSION", 1024))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", 32))
+
+
+class ImageCache:
+    """
+    Small LRU cache of already processed images, kept per chat session so the
+    same attachment is not decoded and re-encoded again on follow-up turns.
+    """
+
+    def __init__(self, max_items: int = IMAGE_CACHE_SIZE):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        # images are processed in worker threads, so the cache must be thread safe
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def downscale_image(
+    image_bytes: bytes, max_dimension: int = MAX_IMAGE_DIMENSION, quality: int = IMAGE_QUALITY
+) -> bytes:
+    """
+    Downscale an image so its longest side is at most max_dimension and re-encode it as JPEG.
+    :param image_bytes: raw image data
+    :param max_dimension: max size in pixels of the longest side
+    :param quality: JPEG quality used to re-encode the image
+    :return: the re-encoded image as bytes
+    """
+    with PILImage.open(BytesIO(image_bytes)) as image:
+        # phone pictures are usually stored rotated, with the orientation in the EXIF data
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), PILImage.Resampling.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def prepare_image(
+    path: str, cache: ImageCache, max_dimension: int = MAX_IMAGE_DIMENSION, quality: int = IMAGE_QUALITY
+) -> bytes:
+    """
+    Read an image from disk and return it downscaled, using the cache when possible.
+    This function is blocking, it is meant to be called from a worker thread.
+    """
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    # the key is based on the content, so re-uploading the same picture hits the cache
+    digest = hashlib.sha1(image_bytes).hexdigest()
+    key = f"{digest}:{max_dimension}:{quality}"
+    image_data = cache.get(key)
+    if image_data is None:
+        image_data = downscale_image(image_bytes, max_dimension, quality)
+        cache.put(key, image_data)
+    return image_data
+
+
+async def load_image_parts(
+    paths: typing.List[str],
+    cache: ImageCache,
+    max_dimension: int = MAX_IMAGE_DIMENSION,
+    quality: int = IMAGE_QUALITY,
+) -> typing.List[Part]:
+    """
+    Read, decode and downscale the images concurrently off the event loop.
+    :param paths: paths of the attached images
+    :param cache: per-session image cache
+    :param max_dimension: max size in pixels of the longest side
+    :param quality: JPEG quality used to re-encode the images
+    :return: list of parts ready to be added to the multimodal prompt
+    """
+    images_data = await asyncio.gather(
+        *[asyncio.to_thread(prepare_image, path, cache, max_dimension, quality) for path in paths]
+    )
+    return [Part.from_data(data=data, mime_type="image/jpeg") for data in images_data]
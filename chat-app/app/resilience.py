@@ -0,0 +1,259 @@
+import asyncio
+import random
+import time
+import typing
+from collections import deque
+from enum import Enum, auto
+
+from google.api_core import exceptions as api_exceptions
+
+# errors worth retrying: the request may succeed if we try again later
+DEFAULT_RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised when a call is rejected because the circuit breaker is open.
+    """
+
+
+class CircuitState(Enum):
+    CLOSED = auto()
+    OPEN = auto()
+    HALF_OPEN = auto()
+
+
+class CircuitBreaker:
+    """
+    Fails fast when the upstream is down: after failure_threshold consecutive failures the
+    circuit opens and calls are rejected, after reset_timeout seconds a single trial call is
+    let through (half open) to check whether the upstream is back. A trial that doesn't report
+    back within trial_timeout seconds is given up, and the next call becomes the trial.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, trial_timeout: float = 120.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = trial_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started_at = 0.0
+
+    def before_call(self):
+        """
+        Check whether a call is allowed.
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("The circuit is open, the upstream service is unavailable.")
+            self.state = CircuitState.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == CircuitState.HALF_OPEN:
+            if self._trial_in_flight and time.monotonic() - self._trial_started_at < self.trial_timeout:
+                raise CircuitOpenError("The circuit is half open, waiting for the trial call.")
+            self._trial_in_flight = True
+            self._trial_started_at = time.monotonic()
+
+    def release_trial(self):
+        """
+        The call ended without a result (e.g. it was cancelled), let the next call be the trial.
+        """
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = CircuitState.OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class ResilientCaller:
+    """
+    Calls an upstream API with exponential backoff and jitter on retryable errors,
+    optional request hedging and a circuit breaker. Keep one instance per upstream,
+    shared by all the sessions, so the latency stats and the breaker see all the traffic.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        timeout: typing.Optional[float] = None,
+        hedge: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 20,
+        breaker: CircuitBreaker = None,
+        retryable_errors: typing.Tuple[typing.Type[BaseException], ...] = DEFAULT_RETRYABLE_ERRORS,
+        log_interval: typing.Optional[float] = 300.0,
+    ):
+        """
+        :param name: name of the upstream, used in the logs
+        :param max_attempts: max number of attempts per call
+        :param base_delay: delay in seconds before the first retry, doubled on each retry
+        :param max_delay: max delay in seconds between retries
+        :param timeout: timeout in seconds of each attempt
+        :param hedge: send a second request if the first one is slower than the p95 latency
+        :param hedge_percentile: latency percentile used as hedging delay
+        :param hedge_min_samples: min number of latency samples before hedging
+        :param breaker: circuit breaker, a new one is created by default
+        :param retryable_errors: exceptions that should be retried
+        :param log_interval: seconds between two logs of the metrics (on the next call), None to only log failures
+        """
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.retryable_errors = retryable_errors
+        self.log_interval = log_interval
+        self._last_log = time.monotonic()
+        self.latencies: typing.Deque[float] = deque(maxlen=200)
+        self.metrics = {
+            "calls": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "failures": 0,
+            "rejected": 0,
+        }
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter, so clients retrying at the same time don't stay in sync.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def hedge_delay(self) -> typing.Optional[float]:
+        """
+        Time to wait before sending a hedged request, None if hedging is disabled
+        or we don't have enough samples yet.
+        """
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+        return latencies[index]
+
+    def is_retryable(self, error: BaseException) -> bool:
+        return isinstance(error, self.retryable_errors)
+
+    async def _timed_call(self, fn: typing.Callable[[], typing.Awaitable[typing.Any]]):
+        start = time.perf_counter()
+        if self.timeout is not None:
+            result = await asyncio.wait_for(fn(), timeout=self.timeout)
+        else:
+            result = await fn()
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    async def _hedged_call(self, fn: typing.Callable[[], typing.Awaitable[typing.Any]]):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._timed_call(fn)
+
+        first = asyncio.ensure_future(self._timed_call(fn))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        # the first request is slower than usual, race it against a second one
+        self.metrics["hedges"] += 1
+        second = asyncio.ensure_future(self._timed_call(fn))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.metrics["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, fn: typing.Callable[[], typing.Awaitable[typing.Any]]):
+        """
+        Call fn with retries, hedging and circuit breaking. fn may be called more than once,
+        even concurrently when hedging, so it must not have side effects.
+        :param fn: function without arguments returning an awaitable
+        :return: the result of fn
+        Raises:
+            CircuitOpenError: If the circuit breaker is open.
+        """
+        self.metrics["calls"] += 1
+        if self.log_interval is not None and time.monotonic() - self._last_log >= self.log_interval:
+            self.log_snapshot("periodic")
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.metrics["rejected"] += 1
+                raise
+            try:
+                result = await self._hedged_call(fn)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # the upstream answered, the request itself is wrong
+                    self.breaker.record_success()
+                    self.metrics["failures"] += 1
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.max_attempts or self.breaker.state == CircuitState.OPEN:
+                    self.metrics["failures"] += 1
+                    self.log_snapshot(f"failed after {attempt} attempts")
+                    raise
+                delay = self.backoff_delay(attempt)
+                self.metrics["retries"] += 1
+                print(f"{self.name}: attempt {attempt} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # cancelled (timeout of the caller, user stopping the turn): neither a success nor a
+                # failure, but the trial slot must not stay taken or the breaker rejects all the calls
+                self.breaker.release_trial()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    def snapshot(self) -> dict:
+        """
+        Current metrics, state of the breaker and hedging delay.
+        """
+        return {
+            **self.metrics,
+            "circuit": self.breaker.state.name.lower(),
+            "hedge_delay": self.hedge_delay(),
+        }
+
+    def log_snapshot(self, reason: str):
+        self._last_log = time.monotonic()
+        print(f"{self.name} resilience metrics ({reason}): {self.snapshot()}")
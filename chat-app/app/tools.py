@@ -0,0 +1,99 @@
+import asyncio
+import time
+import typing
+from dataclasses import dataclass
+
+from vertexai.generative_models import FunctionDeclaration, Part, Tool
+
+DEFAULT_TOOL_TIMEOUT = 60.0
+
+
+@dataclass
+class RegisteredTool:
+    declaration: FunctionDeclaration
+    handler: typing.Callable[..., typing.Awaitable[typing.Any]]
+    timeout: float
+
+
+@dataclass
+class ToolCallResult:
+    name: str
+    response: dict
+    elapsed: float
+
+
+class ToolRegistry:
+    """
+    Registry of the tools (functions) the model can call. Declarations are built once,
+    when the tools are registered, and reused on every request.
+    """
+
+    def __init__(self):
+        self._tools: typing.Dict[str, RegisteredTool] = {}
+        self._model_tools: typing.Optional[typing.List[Tool]] = None
+
+    def register(
+        self,
+        name: str,
+        description: str,
+        parameters: dict,
+        timeout: float = DEFAULT_TOOL_TIMEOUT,
+    ):
+        """
+        Decorator to register an async function as a tool.
+        :param name: name of the function, as seen by the model
+        :param description: description of the function, used by the model to decide when to call it
+        :param parameters: OpenAPI schema of the function arguments
+        :param timeout: max time in seconds the function is allowed to run
+        """
+
+        def decorator(handler):
+            declaration = FunctionDeclaration(name=name, description=description, parameters=parameters)
+            self._tools[name] = RegisteredTool(declaration, handler, timeout)
+            self._model_tools = None
+            return handler
+
+        return decorator
+
+    @property
+    def model_tools(self) -> typing.List[Tool]:
+        """
+        Tools to pass to the model, a tool is a collection of function declarations.
+        """
+        if self._model_tools is None:
+            self._model_tools = [
+                Tool(function_declarations=[tool.declaration for tool in self._tools.values()])
+            ]
+        return self._model_tools
+
+    async def call(self, name: str, args: dict) -> ToolCallResult:
+        """
+        Run a single function call, never raises: errors and timeouts are returned
+        to the model as part of the response so it can recover from them.
+        """
+        start = time.perf_counter()
+        tool = self._tools.get(name)
+        if tool is None:
+            response = {"error": f"Unknown function: {name}"}
+        else:
+            try:
+                result = await asyncio.wait_for(tool.handler(**args), timeout=tool.timeout)
+                response = result if isinstance(result, dict) else {"result": result}
+            except asyncio.TimeoutError:
+                response = {"error": f"The function {name} timed out after {tool.timeout}s"}
+            except Exception as e:
+                response = {"error": f"The function {name} failed: {e}"}
+        elapsed = time.perf_counter() - start
+        print(f"tool call {name} took {elapsed:.2f}s")
+        return ToolCallResult(name, response, elapsed)
+
+    async def execute(self, function_calls: typing.List[typing.Any]) -> typing.List[Part]:
+        """
+        Run all the function calls requested by the model in a turn concurrently.
+        :param function_calls: function calls from the model response
+        :return: function responses, in the same order, to send back to the model in one message
+        """
+        results = await asyncio.gather(
+            *[self.call(function_call.name, dict(function_call.args.items())) for function_call in function_calls]
+        )
+        return [Part.from_function_response(name=result.name, response=result.response) for result in results]
@@ -0,0 +1,487 @@
+"""
+Capacity planning for the models API.
+
+queue_simulation of data_managment.ipynb driven by measured service times: instead of made-up
+exponential rates, the service time of each batch is resampled from latency traces recorded from
+the backend, per model and batch size. The simulated API has N workers pulling requests from a
+shared queue, optional micro-batching (a worker waits up to batch_window seconds for more requests
+of the same model, up to max_batch_size) and an optional autoscaler. For each configuration and
+arrival rate it predicts the latency percentiles and the utilization of the workers, so
+deployments can be sized offline, without trial and error.
+
+The traces are JSON lines {"model": ..., "batch_size": ..., "service_s": ...} written by
+project-template/backend/record_traces.py, or by the API itself when LATENCY_TRACE_PATH is set.
+
+Usage:
+    python capacity_planning.py traces/iris.jsonl --rates 500,1000,2000 --workers 1,2,4
+    python capacity_planning.py traces/*.jsonl --mix iris-model=0.8,flowers-model=0.2 --rates 5,10,20 \
+        --workers 2,4 --batch-windows 0,0.01 --max-batch-size 16 --slo-p99-ms 500 --plot curves.png
+    python capacity_planning.py traces/flowers.jsonl --rate-profile 0:5,300:30,600:5 --duration 900 \
+        --workers 1 --autoscale 1:8
+"""
+import argparse
+import json
+import math
+import random
+import typing
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import numpy as np
+import simpy
+
+# steps of the arrival rate: (start time in seconds, requests per second)
+RateProfile = typing.List[typing.Tuple[float, float]]
+
+# request: (model, arrival time), _RETIRE tells the worker that takes it to stop
+Request = typing.Tuple[typing.Optional[str], float]
+_RETIRE: Request = (None, 0.0)
+
+
+class ServiceTimes:
+    """
+    Recorded service times per model and batch size, resampled by the simulation.
+    A batch size that wasn't recorded is resampled from the closest recorded one, scaled by the
+    ratio of the medians (interpolated linearly between the recorded batch sizes).
+    """
+
+    def __init__(self, samples: typing.Dict[str, typing.Dict[int, typing.Sequence[float]]]):
+        self.samples = {
+            model: {size: list(times) for size, times in sorted(by_size.items()) if len(times)}
+            for model, by_size in samples.items()
+        }
+        self._sizes = {model: list(by_size) for model, by_size in self.samples.items()}
+        self._medians = {
+            model: [float(np.median(times)) for times in by_size.values()] for model, by_size in self.samples.items()
+        }
+
+    @classmethod
+    def from_traces(cls, paths: typing.Iterable[typing.Union[str, Path]]) -> "ServiceTimes":
+        samples: typing.Dict[str, typing.Dict[int, list]] = defaultdict(lambda: defaultdict(list))
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        samples[record["model"]][int(record["batch_size"])].append(float(record["service_s"]))
+        return cls(samples)
+
+    @property
+    def models(self) -> typing.List[str]:
+        return list(self.samples)
+
+    def median(self, model: str, batch_size: int) -> float:
+        sizes, medians = self._sizes[model], self._medians[model]
+        if batch_size > sizes[-1]:
+            # beyond the recorded sizes, assume the time grows linearly with the batch
+            return medians[-1] * batch_size / sizes[-1]
+        return float(np.interp(batch_size, sizes, medians))
+
+    def sample(self, model: str, batch_size: int, rng: random.Random) -> float:
+        by_size = self.samples[model]
+        if batch_size in by_size:
+            return rng.choice(by_size[batch_size])
+        sizes = self._sizes[model]
+        index = min(bisect_left(sizes, batch_size), len(sizes) - 1)
+        if index > 0 and batch_size - sizes[index - 1] < sizes[index] - batch_size:
+            index -= 1
+        nearest = sizes[index]
+        return rng.choice(by_size[nearest]) * self.median(model, batch_size) / self._medians[model][index]
+
+    def summary(self) -> typing.Dict[str, typing.Dict[int, dict]]:
+        return {
+            model: {
+                size: {
+                    "samples": len(times),
+                    "p50_ms": round(float(np.percentile(times, 50)) * 1000, 3),
+                    "p99_ms": round(float(np.percentile(times, 99)) * 1000, 3),
+                }
+                for size, times in by_size.items()
+            }
+            for model, by_size in self.samples.items()
+        }
+
+
+@dataclass
+class Autoscaler:
+    """
+    Autoscaling policy based on the utilization of the workers, like the Kubernetes HPA:
+    every interval, desired = ceil(workers * utilization / target_utilization). New workers are
+    ready after startup_delay (process start and model loading), scaling down uses the highest
+    desired count of the last scale_down_window seconds to avoid flapping.
+    """
+
+    min_workers: int
+    max_workers: int
+    target_utilization: float = 0.6
+    interval: float = 15.0
+    startup_delay: float = 30.0
+    scale_down_window: float = 120.0
+
+
+@dataclass
+class ServerConfig:
+    workers: int
+    batch_window: float = 0.0
+    max_batch_size: int = 1
+    autoscaler: typing.Optional[Autoscaler] = None
+
+    @property
+    def name(self) -> str:
+        name = f"{self.workers} worker{'s' if self.workers > 1 else ''}"
+        if self.max_batch_size > 1:
+            name += f", batch {self.max_batch_size} / {self.batch_window * 1000:g}ms"
+        if self.autoscaler is not None:
+            name += f", autoscale {self.autoscaler.min_workers}-{self.autoscaler.max_workers}"
+        return name
+
+
+class _SimulatedServer:
+    def __init__(
+        self,
+        env: simpy.Environment,
+        service_times: ServiceTimes,
+        config: ServerConfig,
+        rng: random.Random,
+    ):
+        self.env = env
+        self.service_times = service_times
+        self.config = config
+        self.rng = rng
+        self.queue = simpy.FilterStore(env)
+        self.active_workers = 0
+        self.planned_workers = config.workers
+        # (time, active workers) after each change, to integrate the provisioned worker-seconds
+        self.worker_changes: typing.List[typing.Tuple[float, int]] = [(0.0, 0)]
+        self.busy_time = 0.0
+        # (arrival time, latency, model) of the completed requests
+        self.completed: typing.List[typing.Tuple[float, float, str]] = []
+        # requests taken from the queue and not completed yet, per batch
+        self.in_flight: typing.Dict[int, typing.List[Request]] = {}
+        # (start time, service time, batch size) of the batches
+        self.batches: typing.List[typing.Tuple[float, float, int]] = []
+        for _ in range(config.workers):
+            self.start_worker()
+
+    def start_worker(self, delay: float = 0.0):
+        def worker():
+            if delay:
+                yield self.env.timeout(delay)
+            self._set_active(self.active_workers + 1)
+            while True:
+                first = yield self.queue.get()
+                if first is _RETIRE:
+                    self._set_active(self.active_workers - 1)
+                    return
+                model = first[0]
+                batch = [first]
+                self.in_flight[id(batch)] = batch
+                deadline = self.env.now + self.config.batch_window
+                while len(batch) < self.config.max_batch_size:
+                    get = self.queue.get(lambda request: request[0] == model)
+                    if not get.triggered:
+                        remaining = deadline - self.env.now
+                        if remaining <= 0:
+                            get.cancel()
+                            break
+                        yield get | self.env.timeout(remaining)
+                        if not get.triggered:
+                            get.cancel()
+                            break
+                    batch.append(get.value)
+                service_time = self.service_times.sample(model, len(batch), self.rng)
+                self.busy_time += service_time
+                self.batches.append((self.env.now, service_time, len(batch)))
+                yield self.env.timeout(service_time)
+                for _, arrival in batch:
+                    self.completed.append((arrival, self.env.now - arrival, model))
+                del self.in_flight[id(batch)]
+
+        self.env.process(worker())
+
+    def _set_active(self, count: int):
+        self.active_workers = count
+        self.worker_changes.append((self.env.now, count))
+
+    def worker_seconds(self, start: float, end: float) -> float:
+        """
+        Provisioned worker-seconds between start and end.
+        """
+        total = 0.0
+        for (time, count), (next_time, _) in zip(self.worker_changes, self.worker_changes[1:] + [(end, 0)]):
+            total += count * max(0.0, min(next_time, end) - max(time, start))
+        return total
+
+    def arrivals(self, profile: RateProfile, models: typing.List[str], weights: typing.List[float]):
+        steps = sorted(profile)
+        while True:
+            index = bisect_left([start for start, _ in steps], self.env.now + 1e-12) - 1
+            rate = steps[max(index, 0)][1]
+            next_step = steps[index + 1][0] if index + 1 < len(steps) else math.inf
+            interarrival = self.rng.expovariate(rate) if rate > 0 else math.inf
+            if self.env.now + interarrival >= next_step:
+                # the arrivals are memoryless, restart at the next rate
+                yield self.env.timeout(next_step - self.env.now)
+                continue
+            yield self.env.timeout(interarrival)
+            model = self.rng.choices(models, weights)[0]
+            self.queue.put((model, self.env.now))
+
+    def autoscale(self, policy: Autoscaler):
+        recent: typing.List[typing.Tuple[float, int]] = []
+        last_busy = self.busy_time
+        while True:
+            yield self.env.timeout(policy.interval)
+            provisioned = self.worker_seconds(self.env.now - policy.interval, self.env.now)
+            utilization = (self.busy_time - last_busy) / provisioned if provisioned else 1.0
+            last_busy = self.busy_time
+            desired = math.ceil(max(self.active_workers, 1) * utilization / policy.target_utilization)
+            desired = min(max(desired, policy.min_workers), policy.max_workers)
+            recent = [(time, count) for time, count in recent if time > self.env.now - policy.scale_down_window]
+            recent.append((self.env.now, desired))
+            if desired < self.planned_workers:
+                desired = max(count for _, count in recent)
+            for _ in range(desired - self.planned_workers):
+                self.start_worker(policy.startup_delay)
+            for _ in range(self.planned_workers - desired):
+                self.queue.put(_RETIRE)
+            self.planned_workers = desired
+
+
+def _percentiles(latencies: typing.Sequence[float]) -> dict:
+    if not len(latencies):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+def simulate(
+    service_times: ServiceTimes,
+    mix: typing.Dict[str, float],
+    rate: typing.Union[float, RateProfile],
+    config: ServerConfig,
+    duration: float = 300.0,
+    warmup: float = 30.0,
+    report_interval: float = 30.0,
+    seed: int = None,
+) -> dict:
+    """
+    Simulate the API under Poisson arrivals.
+    :param service_times: recorded service times
+    :param mix: share of the requests of each model
+    :param rate: arrival rate in requests per second, or a profile of rate steps
+    :param config: workers, micro-batching and autoscaling of the server
+    :param duration: simulated time in seconds
+    :param warmup: seconds excluded from the statistics, while the queues fill up
+    :param report_interval: length in seconds of the timeline buckets
+    :param seed: seed of the random generator
+    :return: latency percentiles, utilization and a timeline of the run
+    """
+    rng = random.Random(seed)
+    env = simpy.Environment()
+    server = _SimulatedServer(env, service_times, config, rng)
+    profile = [(0.0, float(rate))] if isinstance(rate, (int, float)) else list(rate)
+    models = list(mix)
+    env.process(server.arrivals(profile, models, [mix[model] for model in models]))
+    if config.autoscaler is not None:
+        env.process(server.autoscale(config.autoscaler))
+    env.run(until=duration)
+
+    # requests not completed at the end count with the time they waited so far,
+    # otherwise an overloaded server would look fast
+    pending = [request for batch in server.in_flight.values() for request in batch]
+    pending += [request for request in server.queue.items if request is not _RETIRE]
+    waiting = [(arrival, duration - arrival, model) for model, arrival in pending]
+    requests = [request for request in server.completed + waiting if request[0] >= warmup]
+    arrivals = np.array([arrival for arrival, _, _ in requests])
+    latencies = np.array([latency for _, latency, _ in requests])
+    names = np.array([model for _, _, model in requests])
+    batches = np.array([batch for batch in server.batches if batch[0] >= warmup]).reshape(-1, 3)
+    provisioned = server.worker_seconds(warmup, duration)
+    busy = float(np.minimum(batches[:, 1], duration - batches[:, 0]).sum())
+    utilization = min(busy / provisioned, 1.0) if provisioned else None
+    unfinished = len([request for request in waiting if request[0] >= warmup])
+
+    timeline = []
+    bucket_starts = np.arange(warmup, duration, report_interval)
+    request_buckets = np.searchsorted(bucket_starts, arrivals, side="right") - 1
+    batch_buckets = np.searchsorted(bucket_starts, batches[:, 0], side="right") - 1
+    for index, start in enumerate(bucket_starts.tolist()):
+        end = min(start + report_interval, duration)
+        bucket_provisioned = server.worker_seconds(start, end)
+        bucket_busy = float(batches[batch_buckets == index, 1].sum())
+        bucket_requests = request_buckets == index
+        timeline.append(
+            {
+                "start_s": start,
+                "rate_rps": round(int(bucket_requests.sum()) / (end - start), 2),
+                "p99_ms": _percentiles(latencies[bucket_requests])["p99_ms"],
+                "utilization": round(min(bucket_busy / bucket_provisioned, 1.0), 3) if bucket_provisioned else None,
+                "workers": round(bucket_provisioned / (end - start), 2),
+            }
+        )
+
+    return {
+        "config": config.name,
+        "workers": config.workers,
+        "batch_window_ms": config.batch_window * 1000,
+        "max_batch_size": config.max_batch_size,
+        "autoscaler": asdict(config.autoscaler) if config.autoscaler is not None else None,
+        "rate_rps": rate if isinstance(rate, (int, float)) else None,
+        "requests": len(requests),
+        "unfinished": unfinished,
+        # the queue grows without bound, the percentiles depend on the duration
+        "saturated": (utilization is not None and utilization >= 0.98) or unfinished > 0.01 * len(requests),
+        **_percentiles(latencies),
+        "models": {model: _percentiles(latencies[names == model]) for model in models},
+        "utilization": round(utilization, 3) if utilization is not None else None,
+        "mean_workers": round(provisioned / (duration - warmup), 2),
+        "mean_batch_size": round(float(batches[:, 2].mean()), 2) if len(batches) else None,
+        "timeline": timeline,
+    }
+
+
+def minimum_configs(results: typing.List[dict], slo_p99_ms: float) -> typing.Dict[float, typing.Optional[str]]:
+    """
+    For each arrival rate, the configuration with the fewest workers meeting the p99 SLO.
+    """
+    best = {}
+    for rate in sorted({result["rate_rps"] for result in results}):
+        candidates = [
+            result for result in results
+            if result["rate_rps"] == rate and result["p99_ms"] is not None and result["p99_ms"] <= slo_p99_ms
+            and not result["saturated"]
+        ]
+        candidates.sort(key=lambda result: (result["mean_workers"], result["p99_ms"]))
+        best[rate] = candidates[0]["config"] if candidates else None
+    return best
+
+
+def plot_results(results: typing.List[dict], path: typing.Union[str, Path], slo_p99_ms: float = None):
+    """
+    p99 latency and utilization curves, against the arrival rate, or against the time for a rate profile.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 5))
+    FigureCanvasAgg(fig)
+    latency_ax, utilization_ax = fig.subplots(1, 2)
+    by_config = defaultdict(list)
+    for result in results:
+        by_config[result["config"]].append(result)
+    for config, runs in by_config.items():
+        if runs[0]["rate_rps"] is None:
+            x = [bucket["start_s"] for bucket in runs[0]["timeline"]]
+            latency_ax.plot(x, [bucket["p99_ms"] for bucket in runs[0]["timeline"]], label=config)
+            utilization_ax.plot(x, [bucket["utilization"] for bucket in runs[0]["timeline"]], label=config)
+            workers_ax = utilization_ax.twinx()
+            workers_ax.plot(x, [bucket["workers"] for bucket in runs[0]["timeline"]], "--", label=f"{config} workers")
+            workers_ax.set(ylabel="workers", ylim=(0, None))
+            workers_ax.legend(fontsize="small", loc="lower right")
+            x_label = "time (s)"
+        else:
+            runs = sorted(runs, key=lambda result: result["rate_rps"])
+            x = [result["rate_rps"] for result in runs]
+            latency_ax.plot(x, [result["p99_ms"] for result in runs], marker="o", label=config)
+            utilization_ax.plot(x, [result["utilization"] for result in runs], marker="o", label=config)
+            x_label = "arrival rate (req/s)"
+    if slo_p99_ms is not None:
+        latency_ax.axhline(slo_p99_ms, color="red", linestyle=":", label="SLO")
+    latency_ax.set(xlabel=x_label, ylabel="p99 latency (ms)", yscale="log", title="Predicted p99 latency")
+    utilization_ax.set(xlabel=x_label, ylabel="utilization", title="Worker utilization")
+    latency_ax.legend(fontsize="small")
+    utilization_ax.legend(fontsize="small")
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    return weights
+
+
+def parse_profile(profile: str) -> RateProfile:
+    """
+    Parse a rate profile like "0:50,300:200,600:50" (from 0s 50 req/s, from 300s 200 req/s, ...).
+    """
+    return [(float(start), float(rate)) for start, _, rate in (step.partition(":") for step in profile.split(","))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict the latency and utilization of the models API.")
+    parser.add_argument("traces", nargs="+", help="service time traces (JSON lines)")
+    parser.add_argument("--mix", default=None, help="request mix, e.g. iris-model=0.8,flowers-model=0.2")
+    parser.add_argument("--rates", default="10,50,100", help="comma separated list of arrival rates (req/s)")
+    parser.add_argument("--rate-profile", default=None, help="time varying rate instead of --rates, e.g. 0:50,300:200")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated list of worker counts")
+    parser.add_argument("--batch-windows", default="0", help="comma separated list of batching windows (s)")
+    parser.add_argument("--max-batch-size", type=int, default=1, help="max batch size, 1 disables batching")
+    parser.add_argument("--autoscale", default=None, help="min:max workers, --workers is the initial count")
+    parser.add_argument("--target-utilization", type=float, default=0.6)
+    parser.add_argument("--startup-delay", type=float, default=30.0, help="seconds before a new worker is ready")
+    parser.add_argument("--duration", type=float, default=300.0, help="simulated seconds")
+    parser.add_argument("--warmup", type=float, default=30.0, help="simulated seconds excluded from the statistics")
+    parser.add_argument("--slo-p99-ms", type=float, default=None, help="find the smallest config meeting this p99")
+    parser.add_argument("--output", default=None, help="save the results as JSON")
+    parser.add_argument("--plot", default=None, help="save the latency and utilization curves as an image")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    service_times = ServiceTimes.from_traces(args.traces)
+    if not service_times.models:
+        parser.error("the traces are empty")
+    mix = parse_mix(args.mix) if args.mix else {model: 1.0 for model in service_times.models}
+    unknown = set(mix) - set(service_times.models)
+    if unknown:
+        parser.error(f"no traces for {unknown}, available: {service_times.models}")
+    for model, by_size in service_times.summary().items():
+        for size, stats in by_size.items():
+            print(f"{model} batch size {size:>4}: {stats['samples']:>6} samples  p50 {stats['p50_ms']:>9.3f}ms  p99 {stats['p99_ms']:>9.3f}ms")
+
+    autoscaler = None
+    if args.autoscale:
+        min_workers, _, max_workers = args.autoscale.partition(":")
+        autoscaler = Autoscaler(
+            int(min_workers), int(max_workers), args.target_utilization, startup_delay=args.startup_delay
+        )
+    rates = [parse_profile(args.rate_profile)] if args.rate_profile else [float(r) for r in args.rates.split(",")]
+    configs = [
+        ServerConfig(int(workers), float(window), args.max_batch_size if args.max_batch_size > 1 else 1, autoscaler)
+        for workers in args.workers.split(",")
+        for window in args.batch_windows.split(",")
+    ]
+
+    results = []
+    print(f"\n{'config':<40}{'rate':>8}{'p50':>11}{'p99':>11}{'util':>7}{'workers':>9}{'batch':>7}")
+    for config in configs:
+        for rate in rates:
+            result = simulate(service_times, mix, rate, config, args.duration, args.warmup, seed=args.seed)
+            results.append(result)
+            rate_label = "profile" if result["rate_rps"] is None else f"{result['rate_rps']:g}"
+            saturated = f"  saturated, {result['unfinished']} unfinished" if result["saturated"] else ""
+            print(
+                f"{config.name:<40}{rate_label:>8}{result['p50_ms'] or float('nan'):>9.2f}ms"
+                f"{result['p99_ms'] or float('nan'):>9.2f}ms{result['utilization'] or 0:>7.2f}"
+                f"{result['mean_workers']:>9.2f}{result['mean_batch_size'] or 0:>7.2f}{saturated}"
+            )
+
+    if args.slo_p99_ms is not None and not args.rate_profile:
+        print(f"\nsmallest config meeting p99 <= {args.slo_p99_ms:g}ms:")
+        for rate, config in minimum_configs(results, args.slo_p99_ms).items():
+            print(f"    {rate:>8g} req/s: {config or 'none of the simulated configs'}")
+    if args.output:
+        Path(args.output).write_text(json.dumps({"service_times": service_times.summary(), "results": results}, indent=2))
+        print(f"results saved to {args.output}")
+    if args.plot:
+        plot_results(results, args.plot, args.slo_p99_ms)
+        print(f"curves saved to {args.plot}")
+
+
+if __name__ == "__main__":
+    main()
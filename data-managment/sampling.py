@@ -0,0 +1,360 @@
+"""
+Sampling methods for large datasets.
+
+The same methods as random_sampling in data_managment.ipynb (simple random, systematic,
+stratified and cluster), vectorized over NumPy arrays: they return the indices of the
+selected rows, so they work with any columnar data (arrays, dict of arrays, DataFrames).
+For data that doesn't fit in memory, reservoir and stratified reservoir sampling select
+rows in a single pass over a stream (an iterator, a file or chunks of arrays).
+
+Grouping the rows (np.unique, dicts of lists) is what makes stratified and cluster sampling
+slow on millions of rows: the groups are only counted, and the rows of a group are found by
+drawing random rows, so the cost depends on the sample size rather than the dataset size.
+"""
+import csv
+import itertools
+import math
+import random
+import typing
+from pathlib import Path
+
+import numpy as np
+
+# marks the end of a stream, None could be a valid item
+_END = object()
+
+
+def _rng(seed: typing.Union[int, np.random.Generator, None]) -> np.random.Generator:
+    return seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+
+def _groups(labels: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct labels and the number of rows of each of them. Small integer labels (ages, category
+    codes) are counted with bincount, much faster than the sort done by np.unique.
+    """
+    if labels.dtype.kind in "iub" and len(labels):
+        low, high = int(labels.min()), int(labels.max())
+        if high - low <= max(len(labels), 1 << 16):
+            counts = np.bincount((labels - low).astype(np.intp, copy=False), minlength=high - low + 1)
+            values = np.flatnonzero(counts)
+            return (values + low).astype(labels.dtype), counts[values]
+    return np.unique(labels, return_counts=True)
+
+
+def _sample_group(labels: np.ndarray, value, count: int, size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Select size rows among the count rows whose label is value, without grouping the whole dataset.
+    When the sample is small compared to the group, draws random rows and keeps the first distinct
+    rows of the group (a uniform sample), otherwise scans the labels.
+    """
+    num_rows = len(labels)
+    if size >= count:
+        return np.flatnonzero(labels == value)
+    draws = int(1.5 * size * num_rows / count) + 16
+    if draws < num_rows // 16:
+        for _ in range(4):
+            candidates = rng.integers(0, num_rows, size=draws)
+            candidates = candidates[labels[candidates] == value]
+            _, first = np.unique(candidates, return_index=True)
+            if len(first) >= size:
+                return candidates[np.sort(first)[:size]]
+    return rng.choice(np.flatnonzero(labels == value), size=size, replace=False)
+
+
+def simple_random_sample(num_rows: int, n_samples: int, seed=None) -> np.ndarray:
+    """
+    Select n_samples rows uniformly at random, without replacement.
+    """
+    return _rng(seed).choice(num_rows, size=n_samples, replace=False)
+
+
+def systematic_sample(num_rows: int, n_samples: int, seed=None) -> np.ndarray:
+    """
+    Select the first row randomly, then every k-th row thereafter, where k = num_rows // n_samples.
+    """
+    k = num_rows // n_samples
+    start = _rng(seed).integers(0, k)
+    return np.arange(start, start + k * n_samples, k)
+
+
+def stratified_sample(strata: np.ndarray, n_samples: int, seed=None) -> np.ndarray:
+    """
+    Sample each stratum in proportion to its size.
+    :param strata: stratum of each row, e.g. the gender column (integer codes are the fastest)
+    :param n_samples: total number of samples
+    :return: indices of the selected rows
+    """
+    rng = _rng(seed)
+    strata = np.asarray(strata)
+    values, counts = _groups(strata)
+    sample = [
+        _sample_group(strata, value, count, round(n_samples * count / len(strata)), rng)
+        for value, count in zip(values, counts)
+    ]
+    return np.concatenate(sample) if sample else np.array([], dtype=np.int64)
+
+
+def _first_rows(labels: np.ndarray, values: np.ndarray, counts: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    One random row for each of the values, found together by drawing random rows until every value is hit.
+    """
+    num_rows = len(labels)
+    rows = {}
+    draws = int(num_rows / counts.min() * (np.log(len(values)) + 3))
+    if draws < num_rows // 4:
+        remaining = values
+        for _ in range(4):
+            candidates = rng.integers(0, num_rows, size=draws)
+            hits = candidates[np.isin(labels[candidates], remaining)]
+            found, first = np.unique(labels[hits], return_index=True)
+            rows.update(zip(found.tolist(), hits[first].tolist()))
+            remaining = remaining[~np.isin(remaining, found)]
+            if not len(remaining):
+                break
+    return np.array(
+        [
+            rows[value] if value in rows else int(_sample_group(labels, value, count, 1, rng)[0])
+            for value, count in zip(values.tolist(), counts.tolist())
+        ],
+        dtype=np.int64,
+    )
+
+
+def cluster_sample(
+    clusters: np.ndarray, n_clusters: int, per_cluster: typing.Optional[int] = 1, seed=None
+) -> np.ndarray:
+    """
+    Select n_clusters clusters at random, then per_cluster rows from each of them
+    (all the rows of the selected clusters if per_cluster is None).
+    :param clusters: cluster of each row, e.g. the age column
+    :param n_clusters: number of clusters to select
+    :param per_cluster: number of rows selected in each cluster
+    :return: indices of the selected rows
+    """
+    rng = _rng(seed)
+    clusters = np.asarray(clusters)
+    values, counts = _groups(clusters)
+    selected = rng.choice(len(values), size=n_clusters, replace=False)
+    if per_cluster is None:
+        return np.flatnonzero(np.isin(clusters, values[selected]))
+    if per_cluster == 1:
+        return _first_rows(clusters, values[selected], counts[selected], rng)
+    sample = [
+        _sample_group(clusters, values[cluster], counts[cluster], per_cluster, rng) for cluster in selected
+    ]
+    return np.concatenate(sample)
+
+
+def random_sampling(
+    num_rows: int,
+    n_samples: int,
+    method: str = "simple_random",
+    strata: np.ndarray = None,
+    clusters: np.ndarray = None,
+    seed=None,
+) -> np.ndarray:
+    """
+    Vectorized version of random_sampling, working on row indices instead of lists of objects.
+
+    Parameters:
+    num_rows (int): The number of rows of the dataset.
+    n_samples (int): The number of samples to draw (the number of clusters for 'cluster').
+    method (str): The random sampling method to use.
+                  Options: 'simple_random', 'systematic', 'stratified', 'cluster'.
+    strata (np.ndarray): The stratum of each row, required by 'stratified'.
+    clusters (np.ndarray): The cluster of each row, required by 'cluster'.
+    seed (int): Seed of the random generator, for reproducible samples.
+
+    Returns:
+    np.ndarray: The indices of the selected rows.
+    """
+    if method == "simple_random":
+        return simple_random_sample(num_rows, n_samples, seed)
+    elif method == "systematic":
+        return systematic_sample(num_rows, n_samples, seed)
+    elif method == "stratified":
+        if strata is None:
+            raise ValueError("The stratified method requires the strata of the rows.")
+        return stratified_sample(strata, n_samples, seed)
+    elif method == "cluster":
+        if clusters is None:
+            raise ValueError("The cluster method requires the clusters of the rows.")
+        return cluster_sample(clusters, n_samples, seed=seed)
+    else:
+        raise ValueError(f"Invalid method: {method}")
+
+
+def reservoir_sample(stream: typing.Iterable[typing.Any], k: int, seed=None) -> typing.List[typing.Any]:
+    """
+    Select k items uniformly at random from a stream of unknown length in a single pass,
+    keeping only k items in memory. Uses Algorithm L: instead of drawing a random number per
+    item, it computes how many items to skip before the next replacement.
+    """
+    rng = random.Random(seed)
+    iterator = iter(stream)
+    reservoir = list(itertools.islice(iterator, k))
+    if len(reservoir) < k or k == 0:
+        return reservoir
+    w = math.exp(math.log(rng.random()) / k)
+    while True:
+        skip = math.floor(math.log(rng.random()) / math.log(1 - w))
+        item = next(itertools.islice(iterator, skip, skip + 1), _END)
+        if item is _END:
+            return reservoir
+        reservoir[rng.randrange(k)] = item
+        w *= math.exp(math.log(rng.random()) / k)
+
+
+class _ChunkReservoir:
+    """
+    Reservoir of k rows filled from array chunks, vectorized within each chunk (Algorithm R).
+    """
+
+    def __init__(self, k: int, rng: np.random.Generator):
+        self.k = k
+        self.rng = rng
+        self.rows = None
+        self.seen = 0
+
+    def add(self, chunk: np.ndarray):
+        if self.rows is None:
+            self.rows = np.empty((self.k,) + chunk.shape[1:], dtype=chunk.dtype)
+        # fill the reservoir first
+        fill = min(len(chunk), max(0, self.k - self.seen))
+        self.rows[self.seen: self.seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        positions = self.seen + fill + np.arange(len(rest))
+        self.seen += len(chunk)
+        if len(rest) == 0:
+            return
+        # item i replaces a random slot with probability k / (i + 1)
+        slots = np.floor(self.rng.random(len(rest)) * (positions + 1)).astype(np.int64)
+        replace = np.flatnonzero(slots < self.k)
+        # when several items hit the same slot, the last one wins
+        last_slots, last_index = np.unique(slots[replace][::-1], return_index=True)
+        self.rows[last_slots] = rest[replace[::-1][last_index]]
+
+    def sample(self) -> np.ndarray:
+        if self.rows is None:
+            return np.array([])
+        return self.rows[: min(self.k, self.seen)]
+
+
+def reservoir_sample_chunks(chunks: typing.Iterable[np.ndarray], k: int, seed=None) -> np.ndarray:
+    """
+    Reservoir sampling over a stream of array chunks (e.g. read from a file chunk by chunk),
+    vectorized within each chunk.
+    :param chunks: arrays with the rows along the first axis
+    :param k: number of rows to select
+    :return: the selected rows
+    """
+    reservoir = _ChunkReservoir(k, _rng(seed))
+    for chunk in chunks:
+        reservoir.add(np.asarray(chunk))
+    return reservoir.sample()
+
+
+def _proportional(reservoirs: dict, counts: dict, n_samples: int, take: typing.Callable) -> list:
+    total = sum(counts.values())
+    # a uniform subset of a uniform sample is still a uniform sample
+    return [
+        take(reservoir, min(round(n_samples * counts[stratum] / total), len(reservoir)))
+        for stratum, reservoir in reservoirs.items()
+    ]
+
+
+def stratified_reservoir_sample(
+    stream: typing.Iterable[typing.Any],
+    n_samples: int,
+    key: typing.Callable[[typing.Any], typing.Hashable],
+    seed=None,
+) -> typing.List[typing.Any]:
+    """
+    Stratified sampling in a single pass over a stream, the strata and their sizes are not known
+    in advance. Keeps a reservoir of n_samples items per stratum, then takes from each reservoir
+    a number of items proportional to the size of the stratum. Like reservoir_sample, each
+    reservoir computes the position of its next replacement (Algorithm L), so most items are only
+    counted.
+    :param stream: iterable of items
+    :param n_samples: total number of samples
+    :param key: function returning the stratum of an item
+    :return: the selected items
+    """
+    rng = random.Random(seed)
+    # stratum -> [reservoir, count, position of the next replacement, w]
+    states: typing.Dict[typing.Hashable, list] = {}
+    for item in stream:
+        stratum = key(item)
+        state = states.get(stratum)
+        if state is None:
+            state = states[stratum] = [[], 0, n_samples, 1.0]
+        state[1] += 1
+        if state[1] <= n_samples:
+            state[0].append(item)
+            if state[1] < n_samples:
+                continue
+        elif state[1] == state[2]:
+            state[0][rng.randrange(n_samples)] = item
+        else:
+            continue
+        # the reservoir is full or has just been updated, compute the next replacement
+        state[3] *= math.exp(math.log(rng.random()) / n_samples)
+        state[2] += math.floor(math.log(rng.random()) / math.log(1 - state[3])) + 1
+
+    reservoirs = {stratum: state[0] for stratum, state in states.items()}
+    counts = {stratum: state[1] for stratum, state in states.items()}
+    sample = []
+    for selected in _proportional(reservoirs, counts, n_samples, rng.sample):
+        sample += selected
+    return sample
+
+
+def stratified_reservoir_sample_chunks(
+    chunks: typing.Iterable[typing.Tuple[np.ndarray, np.ndarray]], n_samples: int, seed=None
+) -> np.ndarray:
+    """
+    stratified_reservoir_sample over a stream of array chunks, vectorized within each chunk.
+    :param chunks: (rows, strata) pairs, strata being the stratum of each row of the chunk
+    :param n_samples: total number of samples
+    :return: the selected rows
+    """
+    rng = _rng(seed)
+    reservoirs: typing.Dict[typing.Hashable, _ChunkReservoir] = {}
+    for rows, strata in chunks:
+        rows, strata = np.asarray(rows), np.asarray(strata)
+        for stratum in np.unique(strata).tolist():
+            if stratum not in reservoirs:
+                reservoirs[stratum] = _ChunkReservoir(n_samples, rng)
+            reservoirs[stratum].add(rows[strata == stratum])
+    if not reservoirs:
+        return np.array([])
+    counts = {stratum: reservoir.seen for stratum, reservoir in reservoirs.items()}
+    samples = {stratum: reservoir.sample() for stratum, reservoir in reservoirs.items()}
+    return np.concatenate(
+        _proportional(samples, counts, n_samples, lambda rows, size: rng.permutation(rows)[:size])
+    )
+
+
+def iter_csv(path: typing.Union[str, Path], **kwargs) -> typing.Iterator[dict]:
+    """
+    Read the rows of a CSV file one by one as dictionaries, to sample files that don't fit in memory.
+    """
+    with open(path, newline="") as f:
+        yield from csv.DictReader(f, **kwargs)
+
+
+def iter_csv_chunks(
+    path: typing.Union[str, Path], columns: typing.Sequence[int], chunk_size: int = 100_000, dtype=float
+) -> typing.Iterator[np.ndarray]:
+    """
+    Read some numeric columns of a CSV file (with a header) as chunks of a 2D array.
+    """
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        while True:
+            rows = [[row[i] for i in columns] for row in itertools.islice(reader, chunk_size)]
+            if not rows:
+                return
+            yield np.array(rows, dtype=dtype)
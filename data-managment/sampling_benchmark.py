@@ -0,0 +1,156 @@
+"""
+Benchmark of the sampling methods on a large synthetic dataset.
+
+Compares random_sampling from data_managment.ipynb (a list of Person objects) with the vectorized
+methods of sampling.py (NumPy columns), then measures the streaming methods (reservoir and
+stratified reservoir sampling) on a stream of rows.
+
+Usage:
+    python sampling_benchmark.py
+    python sampling_benchmark.py --rows 100000000 --list-rows 1000000
+"""
+import argparse
+import random
+import time
+import typing
+
+import numpy as np
+
+import sampling
+
+METHODS = ("simple_random", "systematic", "stratified", "cluster")
+GENDERS = np.array(["F", "M"])
+
+
+class Person:
+    def __init__(self, name, age, gender):
+        self.name = name
+        self.age = age
+        self.gender = gender
+
+
+def list_random_sampling(data, n_samples, method="simple_random"):
+    """
+    random_sampling of data_managment.ipynb, the baseline (without the debug print).
+    """
+    if method == "simple_random":
+        return random.sample(data, n_samples)
+    elif method == "systematic":
+        k = len(data) // n_samples
+        start = random.randint(0, k - 1)
+        return [data[i] for i in range(start, len(data), k)][:n_samples]
+    elif method == "stratified":
+        strata = {}
+        for person in data:
+            if person.gender not in strata:
+                strata[person.gender] = [person]
+            else:
+                strata[person.gender].append(person)
+        sample = []
+        for stratum in strata.values():
+            n_sample_stratum = round(n_samples * len(stratum) / len(data))
+            sample += random.sample(stratum, n_sample_stratum)
+        return sample
+    elif method == "cluster":
+        clusters = {}
+        for person in data:
+            if person.age not in clusters:
+                clusters[person.age] = [person]
+            else:
+                clusters[person.age].append(person)
+        sample = []
+        for cluster in random.sample(list(clusters.keys()), n_samples):
+            sample += random.sample(clusters[cluster], 1)
+        return sample
+    else:
+        raise ValueError(f"Invalid method: {method}")
+
+
+def generate_columns(num_rows: int, seed: int = 0) -> typing.Dict[str, np.ndarray]:
+    """
+    Synthetic people, the gender is stored as codes of GENDERS like a categorical column.
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        "age": rng.integers(18, 90, size=num_rows, dtype=np.int8),
+        "gender": (rng.random(num_rows) < 0.48).astype(np.int8),
+    }
+
+
+def measure(fn: typing.Callable, repeat: int) -> float:
+    """
+    Best time of repeat runs, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def compare_methods(columns: typing.Dict[str, np.ndarray], list_rows: int, n_samples: int, repeat: int):
+    """
+    Time the list version and the vectorized version of each method, the list version on the
+    first list_rows rows.
+    """
+    num_rows = len(columns["age"])
+    start = time.perf_counter()
+    ages, genders = columns["age"][:list_rows].tolist(), GENDERS[columns["gender"][:list_rows]].tolist()
+    people = [Person(str(i), age, gender) for i, (age, gender) in enumerate(zip(ages, genders))]
+    print(f"built {list_rows:,} Person objects in {time.perf_counter() - start:.1f}s")
+
+    print(f"\n{'method':<16}{'list':>12}{'vectorized':>14}{'speedup':>10}")
+    for method in METHODS:
+        list_time = measure(lambda: list_random_sampling(people, n_samples, method), repeat)
+        vectorized_time = measure(
+            lambda: sampling.random_sampling(
+                num_rows, n_samples, method, strata=columns["gender"], clusters=columns["age"]
+            ),
+            repeat,
+        )
+        speedup = f"{list_time / vectorized_time:.1f}x" if list_rows == num_rows else "-"
+        print(f"{method:<16}{list_time * 1000:>10.1f}ms{vectorized_time * 1000:>12.1f}ms{speedup:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sampling methods.")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="rows of the vectorized dataset")
+    parser.add_argument(
+        "--list-rows", type=int, default=None, help="rows of the list of Person, --rows by default (no speedup if less)"
+    )
+    parser.add_argument("--stream-rows", type=int, default=1_000_000, help="rows of the streaming benchmark")
+    parser.add_argument("--samples", type=int, default=50, help="number of samples (clusters for 'cluster')")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    list_rows = args.list_rows or args.rows
+
+    start = time.perf_counter()
+    columns = generate_columns(args.rows)
+    print(f"generated {args.rows:,} rows in {time.perf_counter() - start:.1f}s")
+    # the Person objects only live during the comparison
+    compare_methods(columns, list_rows, args.samples, args.repeat)
+
+    ages, genders = columns["age"][: args.stream_rows], columns["gender"][: args.stream_rows]
+    rows = list(zip(ages.tolist(), GENDERS[genders].tolist()))
+    print(f"\nstreaming {len(rows):,} rows, {args.samples} samples")
+    streaming = {
+        "reservoir (algorithm L)": lambda: sampling.reservoir_sample(iter(rows), args.samples),
+        "reservoir (chunks)": lambda: sampling.reservoir_sample_chunks(
+            (ages[i: i + 100_000] for i in range(0, len(ages), 100_000)), args.samples
+        ),
+        "stratified reservoir": lambda: sampling.stratified_reservoir_sample(
+            iter(rows), args.samples, key=lambda row: row[1]
+        ),
+        "stratified (chunks)": lambda: sampling.stratified_reservoir_sample_chunks(
+            ((ages[i: i + 100_000], genders[i: i + 100_000]) for i in range(0, len(ages), 100_000)), args.samples
+        ),
+        "full scan (baseline)": lambda: random.sample(list(iter(rows)), args.samples),
+    }
+    for name, fn in streaming.items():
+        elapsed = measure(fn, args.repeat)
+        print(f"{name:<24}{elapsed * 1000:>10.1f}ms{len(rows) / elapsed / 1e6:>10.1f}M rows/s")
+
+
+if __name__ == "__main__":
+    main()
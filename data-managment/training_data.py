@@ -0,0 +1,268 @@
+"""
+Reusable input pipelines and training helpers for the notebooks.
+
+- build_pipeline: parallel preprocessing, caching of the deterministic part, shuffling,
+  batching, parallel augmentation and prefetching.
+- export_tfrecords / load_tfrecords: sharded TFRecord files, read back in parallel.
+- AsyncCheckpointer: checkpoints written in the background, training continues meanwhile.
+- SampleRenderer: renders sample images in a background thread, out of the training loop.
+- TrainingStats: steps/sec and time spent waiting for the input pipeline.
+"""
+import queue
+import threading
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def build_pipeline(
+    dataset: tf.data.Dataset,
+    batch_size: int,
+    preprocess_fn: typing.Callable = None,
+    augment_fn: typing.Callable = None,
+    shuffle_buffer: int = None,
+    cache: typing.Union[bool, str] = True,
+    drop_remainder: bool = False,
+    seed: int = None,
+) -> tf.data.Dataset:
+    """
+    Build a training input pipeline.
+    :param dataset: dataset of raw samples
+    :param batch_size: batch size
+    :param preprocess_fn: deterministic preprocessing (decode, resize, normalize), its result is cached
+    :param augment_fn: random augmentation applied to each batch, after the cache so it changes every epoch
+    :param shuffle_buffer: size of the shuffle buffer, no shuffling if None
+    :param cache: True to cache in memory, a file path to cache on disk, False to disable
+    :param drop_remainder: drop the last incomplete batch, e.g. when the train step expects a fixed batch size
+    :param seed: shuffle seed
+    :return: the batched and prefetched dataset
+    """
+    if preprocess_fn is not None:
+        dataset = dataset.map(preprocess_fn, num_parallel_calls=AUTOTUNE)
+    if cache:
+        # the preprocessing is done once, the following epochs read from the cache
+        dataset = dataset.cache() if cache is True else dataset.cache(str(cache))
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder, num_parallel_calls=AUTOTUNE)
+    if augment_fn is not None:
+        dataset = dataset.map(augment_fn, num_parallel_calls=AUTOTUNE)
+    # prepare the next batches while the model is training on the current one
+    return dataset.prefetch(AUTOTUNE)
+
+
+def decode_image(image_bytes: tf.Tensor, image_size: typing.Tuple[int, int] = None, channels: int = 3) -> tf.Tensor:
+    """
+    Decode an encoded image (jpeg, png, ...) as float32 in [0, 1], resized if image_size is given.
+    """
+    image = tf.io.decode_image(image_bytes, channels=channels, expand_animations=False)
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    if image_size is not None:
+        image = tf.image.resize(image, image_size)
+    return image
+
+
+def _bytes_feature(value: tf.Tensor) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(value).numpy()]))
+
+
+def export_tfrecords(
+    dataset: tf.data.Dataset,
+    output_folder: typing.Union[str, Path],
+    num_shards: int = 8,
+    prefix: str = "data",
+) -> typing.List[Path]:
+    """
+    Save a dataset of tensors (or tuples/dicts of tensors) as sharded TFRecord files,
+    samples are distributed round-robin between the shards.
+    :param dataset: unbatched dataset
+    :param output_folder: folder where the shards are saved
+    :param num_shards: number of files
+    :param prefix: prefix of the file names
+    :return: paths of the shards
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    paths = [output_folder / f"{prefix}-{i:05d}-of-{num_shards:05d}.tfrecord" for i in range(num_shards)]
+    writers = [tf.io.TFRecordWriter(str(path)) for path in paths]
+    try:
+        for i, sample in enumerate(dataset):
+            flat = tf.nest.flatten(sample)
+            features = {f"t{j}": _bytes_feature(tensor) for j, tensor in enumerate(flat)}
+            example = tf.train.Example(features=tf.train.Features(feature=features))
+            writers[i % num_shards].write(example.SerializeToString())
+    finally:
+        for writer in writers:
+            writer.close()
+    return paths
+
+
+def load_tfrecords(
+    pattern: str,
+    element_spec: typing.Any,
+    num_parallel_reads: int = AUTOTUNE,
+) -> tf.data.Dataset:
+    """
+    Read the shards written by export_tfrecords, in parallel.
+    :param pattern: glob pattern of the shards, e.g. "records/data-*.tfrecord"
+    :param element_spec: element_spec of the exported dataset, used to parse the tensors back
+    :param num_parallel_reads: number of files read at the same time
+    :return: dataset with the same structure as the exported one
+    """
+    specs = tf.nest.flatten(element_spec)
+    feature_description = {f"t{j}": tf.io.FixedLenFeature([], tf.string) for j in range(len(specs))}
+
+    def parse(record):
+        features = tf.io.parse_single_example(record, feature_description)
+        tensors = [
+            tf.ensure_shape(tf.io.parse_tensor(features[f"t{j}"], spec.dtype), spec.shape)
+            for j, spec in enumerate(specs)
+        ]
+        return tf.nest.pack_sequence_as(element_spec, tensors)
+
+    files = tf.data.Dataset.list_files(pattern, shuffle=False)
+    dataset = tf.data.TFRecordDataset(files, num_parallel_reads=num_parallel_reads)
+    return dataset.map(parse, num_parallel_calls=AUTOTUNE)
+
+
+class AsyncCheckpointer:
+    """
+    Save checkpoints without stopping the training: the variables are copied and written
+    to disk in the background, only the next save waits for the previous one to finish.
+    """
+
+    def __init__(self, checkpoint: tf.train.Checkpoint, directory: typing.Union[str, Path], max_to_keep: int = 3):
+        self.manager = tf.train.CheckpointManager(checkpoint, str(directory), max_to_keep=max_to_keep)
+        self.options = tf.train.CheckpointOptions(enable_async=True)
+        self.save_time = 0.0
+
+    def save(self, step: int = None) -> str:
+        start = time.perf_counter()
+        path = self.manager.save(checkpoint_number=step, options=self.options)
+        self.save_time += time.perf_counter() - start
+        return path
+
+    def restore_latest(self):
+        return self.manager.checkpoint.restore(self.manager.latest_checkpoint)
+
+    def sync(self):
+        """
+        Wait until the pending checkpoint is written, call it at the end of the training.
+        """
+        self.manager.checkpoint.sync()
+
+
+class SampleRenderer:
+    """
+    Render grids of sample images in a background thread, so the training loop only pays for
+    the model forward pass and a copy to numpy. Uses the object oriented matplotlib API
+    (no pyplot), which is safe to use outside the main thread.
+    """
+
+    def __init__(self, output_folder: typing.Union[str, Path] = ".", file_pattern: str = "image_at_epoch_{:04d}.png"):
+        self.output_folder = Path(output_folder)
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        self.file_pattern = file_pattern
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sample-renderer", daemon=True)
+        self._thread.start()
+
+    def submit(self, epoch: int, images: typing.Union[np.ndarray, tf.Tensor]):
+        """
+        Queue a batch of images in [-1, 1] (generator output) to be saved as a grid.
+        """
+        self._queue.put((epoch, np.asarray(images)))
+
+    def _run(self):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            epoch, images = item
+            try:
+                grid = int(np.ceil(np.sqrt(images.shape[0])))
+                fig = Figure(figsize=(4, 4))
+                FigureCanvasAgg(fig)
+                for i in range(images.shape[0]):
+                    ax = fig.add_subplot(grid, grid, i + 1)
+                    ax.imshow(images[i, :, :, 0] * 127.5 + 127.5, cmap="gray")
+                    ax.axis("off")
+                fig.savefig(self.output_folder / self.file_pattern.format(epoch))
+            except Exception as e:
+                print(f"Failed to render the samples of epoch {epoch}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """
+        Wait until all the queued images are saved.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+class TrainingStats:
+    """
+    Measure the training throughput and how long the training loop waits for the input pipeline.
+    A high stall ratio means the model is starved: add parallelism, caching or prefetching.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.step_time = 0.0
+        self.input_wait_time = 0.0
+
+    def iterate(self, dataset: tf.data.Dataset) -> typing.Iterator[typing.Any]:
+        """
+        Iterate over a dataset, measuring the time spent waiting for each batch.
+        """
+        iterator = iter(dataset)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.input_wait_time += time.perf_counter() - start
+            yield batch
+
+    def step(self, train_step: typing.Callable, *args, **kwargs):
+        """
+        Run a train step and measure it. The outputs are not read back, so with tf.function
+        the time includes the dispatch of the step and waiting for the previous one.
+        """
+        start = time.perf_counter()
+        result = train_step(*args, **kwargs)
+        self.step_time += time.perf_counter() - start
+        self.steps += 1
+        return result
+
+    def reset(self):
+        self.steps = 0
+        self.step_time = 0.0
+        self.input_wait_time = 0.0
+
+    def summary(self) -> dict:
+        total = self.step_time + self.input_wait_time
+        return {
+            "steps": self.steps,
+            "steps_per_sec": self.steps / total if total else 0.0,
+            "input_wait_s": self.input_wait_time,
+            "stall_ratio": self.input_wait_time / total if total else 0.0,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return (
+            f"{summary['steps']} steps, {summary['steps_per_sec']:.1f} steps/sec, "
+            f"input pipeline stall {summary['input_wait_s']:.2f}s ({summary['stall_ratio']:.1%})"
+        )
@@ -1,31 +1,104 @@
-from fastapi import FastAPI, Request, UploadFile, File
+from fastapi import FastAPI, Request
 from contextlib import asynccontextmanager
 from models import IrisModel, FlowersModel, Framework
 from iris_model_router import router as iris_model_router
 from flowers_model_router import router as flowers_model_router
 from pathlib import Path
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from datetime import datetime
 import numpy as np
+import os
+import time
+from metrics import REGISTRY, REQUEST_LATENCY, TRACES, stage_timer
+from profiler import profiler
+
+# number of worker processes when started by prefork.py, each of them has its own profiler
+PREFORK_WORKERS = int(os.environ.get("PREFORK_WORKERS", "1"))
+
+
+# the models can be swapped through environment variables, e.g. to run the benchmarks with a stub model
+IRIS_FRAMEWORK = Framework[os.environ.get("IRIS_FRAMEWORK", "sklearn").upper()]
+IRIS_MODEL_PATH = os.environ.get("IRIS_MODEL_PATH", "./../models/iris-model/sklearn/model.pk")
+FLOWERS_MODEL_PATH = os.environ.get("FLOWERS_MODEL_PATH", "./../models/flowers-model/model.keras")
+# quantized variants published by quantize.py, e.g. FLOWERS_VARIANT=int8
+IRIS_VARIANT = os.environ.get("IRIS_VARIANT") or None
+FLOWERS_VARIANT = os.environ.get("FLOWERS_VARIANT") or None
+
+
+# name -> (model class, framework, model path, variant)
+MODEL_SPECS = {
+    "iris": (IrisModel, IRIS_FRAMEWORK, IRIS_MODEL_PATH, IRIS_VARIANT),
+    "flowers": (FlowersModel, Framework.TENSORFLOW, FLOWERS_MODEL_PATH, FLOWERS_VARIANT),
+}
+# models loaded before the workers are forked, shared copy-on-write by all of them
+preloaded_models = dict()
+
+
+def create_model(name: str):
+    model_class, framework, model_path, variant = MODEL_SPECS[name]
+    return model_class(framework=framework, model_path=model_path, variant=variant)
+
+
+def preload_models():
+    """
+    Load the models that can be shared with forked worker processes. TensorFlow models are
+    skipped: the TF runtime is not fork-safe, so each worker loads its own copy after the fork.
+    """
+    for name, (_, framework, _, _) in MODEL_SPECS.items():
+        if framework != Framework.TENSORFLOW:
+            preloaded_models[name] = create_model(name)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.state.model_garden = dict()
     print("api starting...")
-    app.state.model_garden["iris"] = IrisModel(
-        framework=Framework.SKLEARN,
-        model_path="./../models/iris-model/sklearn/model.pk",
-    )
-    app.state.model_garden["flowers"] = FlowersModel(
-        framework=Framework.TENSORFLOW,
-        model_path="./../models/flowers-model/model.keras",
-    )
+    for name in MODEL_SPECS:
+        if name in preloaded_models:
+            app.state.model_garden[name] = preloaded_models[name]
+        else:
+            app.state.model_garden[name] = create_model(name)
+    # with several workers, save the metrics of this worker for the /metrics of the others
+    REGISTRY.start_flusher()
     yield
     print("api shutting down...")
+    if REGISTRY.multiprocess_dir is not None:
+        REGISTRY.flush()
+
+
+class RequestLatencyMiddleware:
+    """
+    Records the latency of each request in REQUEST_LATENCY. A plain ASGI middleware, cheaper
+    than @app.middleware("http") which wraps every request and response in extra objects.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = 500  # an exception in the handler becomes a 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # use the route template and not the raw path, to keep the number of labels bounded
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            REQUEST_LATENCY.labels(scope["method"], path, str(status_code)).observe(time.perf_counter() - start)
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestLatencyMiddleware)
 
 
 @app.get("/")
@@ -36,23 +109,103 @@ def say_hi():
 @app.post("/iris-model/predict")
 async def predict_iris(request: Request):
     iris_model = request.app.state.model_garden["iris"]
-    data = await request.json()
-    sepallength = data["sepal_length"]
-    sepalwidth = data["sepal_width"]
-    petallength = data["petal_length"]
-    petalwidth = data["petal_width"]
-    prediction = iris_model.predict(
-        np.array([[sepallength, sepalwidth, petallength, petalwidth]])
-    )
-    return JSONResponse(content={"prediction": prediction}, status_code=200)
+    with stage_timer(iris_model.model_name, "parse"):
+        data = await request.json()
+        sepallength = data["sepal_length"]
+        sepalwidth = data["sepal_width"]
+        petallength = data["petal_length"]
+        petalwidth = data["petal_width"]
+        X = np.array([[sepallength, sepalwidth, petallength, petalwidth]])
+    with TRACES.time(iris_model.model_name, len(X)):
+        prediction = iris_model.predict(X)
+    with stage_timer(iris_model.model_name, "serialize"):
+        return JSONResponse(content={"prediction": prediction}, status_code=200)
+
+
+@app.post("/iris-model/predict/batch")
+async def predict_iris_batch(request: Request):
+    iris_model = request.app.state.model_garden["iris"]
+    with stage_timer(iris_model.model_name, "parse"):
+        data = await request.json()
+        X = np.array(
+            [
+                [x["sepal_length"], x["sepal_width"], x["petal_length"], x["petal_width"]]
+                for x in data["instances"]
+            ]
+        )
+    with TRACES.time(iris_model.model_name, len(X)):
+        predictions = iris_model.predict(X)
+    with stage_timer(iris_model.model_name, "serialize"):
+        return JSONResponse(content={"predictions": predictions}, status_code=200)
 
 
 @app.post("/flowers-model/predict")
-async def predict_flowers(request: Request, image: UploadFile = File(...)):
+async def predict_flowers(request: Request):
     flowers_model = request.app.state.model_garden["flowers"]
-    image_bytes: bytes = await image.read()  # read the image as bytes
-    predictions = flowers_model.predict(image_bytes)
-    return JSONResponse(content={"predictions": predictions}, status_code=200)
+    # the multipart body is parsed here and not by an UploadFile parameter, so "parse" includes it
+    with stage_timer(flowers_model.model_name, "parse"):
+        async with request.form() as form:
+            image = form.get("image")
+            if image is None or isinstance(image, str):
+                return JSONResponse(content={"error": "an image file is required"}, status_code=422)
+            image_bytes: bytes = await image.read()  # read the image as bytes
+    with TRACES.time(flowers_model.model_name, 1):
+        predictions = flowers_model.predict(image_bytes)
+    with stage_timer(flowers_model.model_name, "serialize"):
+        return JSONResponse(content={"predictions": predictions}, status_code=200)
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Latency histograms in the Prometheus text format, summed over all the workers.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def prefork_profiler_error():
+    # each request goes to any worker, the samples would be spread over unrelated profilers
+    return JSONResponse(
+        content={
+            "error": f"the profiler is disabled with {PREFORK_WORKERS} workers, "
+            "profile a single worker started with python main.py"
+        },
+        status_code=409,
+    )
+
+
+@app.post("/profiler/start")
+def start_profiler(interval: float = 0.01):
+    """
+    Start the sampling profiler, interval is the time in seconds between two samples.
+    """
+    if PREFORK_WORKERS > 1:
+        return prefork_profiler_error()
+    try:
+        profiler.start(interval=interval)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(content={"running": profiler.running}, status_code=200)
+
+
+@app.post("/profiler/stop")
+def stop_profiler():
+    if PREFORK_WORKERS > 1:
+        return prefork_profiler_error()
+    profiler.stop()
+    return JSONResponse(content=profiler.report(), status_code=200)
+
+
+@app.get("/profiler")
+def profiler_report(limit: int = 20, collapsed: bool = False):
+    """
+    Profiler samples, as a summary or in the collapsed stack format used by flame graph tools.
+    """
+    if PREFORK_WORKERS > 1:
+        return prefork_profiler_error()
+    if collapsed:
+        return PlainTextResponse(profiler.collapsed())
+    return JSONResponse(content=profiler.report(limit=limit), status_code=200)
 
 
 # @asynccontextmanager
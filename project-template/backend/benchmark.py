@@ -0,0 +1,436 @@
+"""
+Load testing and benchmark harness for the models API.
+
+Starts the API in a subprocess with the shipped iris models (and a small stub flowers model
+with --stub-flowers or when the trained one is missing, so it can run offline), drives it with
+a configurable concurrency and request mix, and reports latency percentiles, throughput and the
+peak RSS of the server during each run. Results are saved as JSON in benchmark-results/ so runs of different commits
+can be compared.
+
+Usage:
+    python benchmark.py --stub-flowers --concurrency 1,4,16 --requests 500
+    python benchmark.py --mix iris-single=0.8,iris-batch=0.2 --compare
+    python benchmark.py --stub-flowers --workers 1,2,4 --concurrency 16   # production mode scaling
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image as PILImage
+
+BACKEND_FOLDER = Path(__file__).resolve().parent
+RESULTS_FOLDER = BACKEND_FOLDER / "benchmark-results"
+IRIS_MODELS = {
+    "sklearn": "./../models/iris-model/sklearn/model.pk",
+    "tensorflow": "./../models/iris-model/keras/model.keras",
+}
+# the trained flowers model, not in the repository
+FLOWERS_MODEL = "./../models/flowers-model/model.keras"
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    path: str
+    body: bytes
+    headers: typing.Dict[str, str]
+
+
+def make_iris_instance(rng: random.Random) -> dict:
+    return {
+        "sepal_length": round(rng.uniform(4.3, 7.9), 1),
+        "sepal_width": round(rng.uniform(2.0, 4.4), 1),
+        "petal_length": round(rng.uniform(1.0, 6.9), 1),
+        "petal_width": round(rng.uniform(0.1, 2.5), 1),
+    }
+
+
+def make_jpeg(size: int, seed: int = 0) -> bytes:
+    """
+    Random RGB image of size x size pixels encoded as JPEG.
+    """
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    output = BytesIO()
+    PILImage.fromarray(pixels).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def multipart_body(field: str, filename: str, content: bytes, content_type: str):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def build_scenarios(batch_size: int, image_sizes: typing.List[int], seed: int) -> typing.Dict[str, Scenario]:
+    """
+    Requests the load generator can send, keyed by name.
+    """
+    rng = random.Random(seed)
+    json_headers = {"Content-Type": "application/json"}
+    scenarios = {
+        "iris-single": Scenario(
+            "iris-single", "POST", "/iris-model/predict",
+            json.dumps(make_iris_instance(rng)).encode(), json_headers,
+        ),
+        "iris-batch": Scenario(
+            "iris-batch", "POST", "/iris-model/predict/batch",
+            json.dumps({"instances": [make_iris_instance(rng) for _ in range(batch_size)]}).encode(), json_headers,
+        ),
+    }
+    for size in image_sizes:
+        body, headers = multipart_body("image", f"image_{size}.jpg", make_jpeg(size, seed), "image/jpeg")
+        scenarios[f"flowers-{size}"] = Scenario(f"flowers-{size}", "POST", "/flowers-model/predict", body, headers)
+    return scenarios
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    """
+    Parse a request mix like "iris-single=0.7,flowers-224=0.3".
+    """
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight) if weight else 1.0
+    return weights
+
+
+def make_stub_flowers_model(path: Path):
+    """
+    Save a tiny untrained model with the same input and output shapes as the flowers model,
+    so the flowers endpoint can be benchmarked without the trained weights.
+    """
+    import keras
+
+    model = keras.Sequential(
+        [
+            keras.Input(shape=(180, 180, 3)),
+            keras.layers.Conv2D(8, 3, strides=2, activation="relu"),
+            keras.layers.GlobalAveragePooling2D(),
+            keras.layers.Dense(5),
+        ]
+    )
+    model.save(path)
+
+
+class Server:
+    """
+    The API running in a subprocess, a single uvicorn process or the production mode with N workers.
+    """
+
+    def __init__(self, port: int, env: typing.Dict[str, str], workers: int = None, pin_cpus: bool = False):
+        self.port = port
+        self.env = env
+        self.workers = workers
+        self.pin_cpus = pin_cpus
+        self.process: typing.Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 180.0):
+        if self.workers is None:
+            command = [sys.executable, "-m", "uvicorn", "api:app", "--port", str(self.port), "--log-level", "warning"]
+        else:
+            command = [sys.executable, "main.py", "--prod", "--workers", str(self.workers), "--port", str(self.port)]
+            if self.pin_cpus:
+                command.append("--pin-cpus")
+        self.process = subprocess.Popen(
+            command,
+            cwd=BACKEND_FOLDER,
+            env={**os.environ, **self.env},
+        )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The API failed to start.")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                connection.request("GET", "/")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                time.sleep(0.5)
+        self.stop()
+        raise RuntimeError(f"The API didn't start in {timeout}s.")
+
+    def pids(self) -> typing.List[int]:
+        """
+        Pids of the server and its workers.
+        """
+        pids = [self.process.pid]
+        children_file = Path(f"/proc/{self.process.pid}/task/{self.process.pid}/children")
+        if children_file.exists():
+            pids += [int(pid) for pid in children_file.read_text().split()]
+        return pids
+
+    def reset_peak_rss(self):
+        """
+        Reset the peak RSS of the server and its workers (Linux only), to measure it per run.
+        """
+        for pid in self.pids():
+            try:
+                Path(f"/proc/{pid}/clear_refs").write_text("5")
+            except OSError:
+                pass
+
+    def peak_rss_mb(self) -> typing.Optional[float]:
+        """
+        Sum of the peak RSS of the server and its workers since the last reset (Linux only).
+        """
+        if not Path("/proc/self/status").exists():
+            return None
+        total = 0.0
+        for pid in self.pids():
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("VmHWM:"):
+                    total += int(line.split()[1]) / 1024
+        return round(total, 1)
+
+    def memory_usage(self) -> typing.Optional[dict]:
+        """
+        Memory of the server and its workers (Linux only). PSS splits the shared pages between
+        the processes sharing them, so it shows what each worker really costs.
+        """
+        if not Path("/proc/self/smaps_rollup").exists():
+            return None
+        pids = self.pids()
+        usage = {"processes": len(pids), "rss_mb": 0.0, "pss_mb": 0.0}
+        for pid in pids:
+            for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    usage[f"{key.lower()}_mb"] += int(value.split()[0]) / 1024
+        workers = max(1, len(pids) - 1)
+        usage["pss_mb_per_worker"] = usage["pss_mb"] / workers
+        return {key: round(value, 1) for key, value in usage.items()}
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def run_load(
+    port: int,
+    scenarios: typing.Dict[str, Scenario],
+    weights: typing.Dict[str, float],
+    concurrency: int,
+    num_requests: int,
+    seed: int,
+) -> dict:
+    """
+    Send num_requests requests with concurrency workers, each one on its own keep-alive connection.
+    :return: latency percentiles and throughput, overall and per scenario
+    """
+    names = list(weights)
+    rng = random.Random(seed)
+    plan = rng.choices(names, weights=[weights[name] for name in names], k=num_requests)
+    records: typing.List[typing.Tuple[str, float, int]] = []
+    lock = threading.Lock()
+    next_request = iter(plan)
+
+    def worker():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while True:
+            with lock:
+                name = next(next_request, None)
+            if name is None:
+                break
+            scenario = scenarios[name]
+            start = time.perf_counter()
+            try:
+                connection.request(scenario.method, scenario.path, body=scenario.body, headers=scenario.headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                status = 0
+            latency = time.perf_counter() - start
+            with lock:
+                records.append((name, latency, status))
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    def summarize(items):
+        latencies = np.array([latency for _, latency, _ in items]) * 1000
+        return {
+            "requests": len(items),
+            "errors": sum(1 for _, _, status in items if status != 200),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+            "mean_ms": round(float(latencies.mean()), 2),
+        }
+
+    return {
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(records) / elapsed, 2),
+        **summarize(records),
+        "scenarios": {
+            name: summarize([r for r in records if r[0] == name]) for name in names if name in set(plan)
+        },
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_FOLDER, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_run(run: dict, previous: dict = None):
+    workers = f"workers {run['workers']:>2}, " if run["workers"] is not None else ""
+    line = (
+        f"{workers}concurrency {run['concurrency']:>3}: {run['throughput_rps']:>8.1f} req/s  "
+        f"p50 {run['p50_ms']:>8.2f}ms  p95 {run['p95_ms']:>8.2f}ms  p99 {run['p99_ms']:>8.2f}ms  "
+        f"errors {run['errors']}"
+    )
+    if run.get("peak_rss_mb") is not None:
+        line += f"  peak RSS {run['peak_rss_mb']:.1f}MB"
+    if previous is not None:
+        throughput = (run["throughput_rps"] / previous["throughput_rps"] - 1) * 100
+        p95 = (run["p95_ms"] / previous["p95_ms"] - 1) * 100
+        line += f"  (vs {previous['commit']}: throughput {throughput:+.1f}%, p95 {p95:+.1f}%)"
+    print(line)
+    for name, stats in run["scenarios"].items():
+        print(f"    {name:<16} p50 {stats['p50_ms']:>8.2f}ms  p95 {stats['p95_ms']:>8.2f}ms  p99 {stats['p99_ms']:>8.2f}ms")
+
+
+def load_previous(config: dict) -> typing.Dict[typing.Tuple[typing.Optional[int], int], dict]:
+    """
+    Runs of the most recent saved result with the same configuration, keyed by (workers, concurrency).
+    """
+    for path in sorted(RESULTS_FOLDER.glob("*.json"), reverse=True):
+        result = json.loads(path.read_text())
+        if result["config"] == config:
+            return {
+                (run.get("workers"), run["concurrency"]): {**run, "commit": result["commit"]}
+                for run in result["runs"]
+            }
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the models API.")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated list of concurrency levels")
+    parser.add_argument("--requests", type=int, default=500, help="number of requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="number of warmup requests")
+    parser.add_argument("--mix", default="iris-single=0.6,iris-batch=0.2,flowers-224=0.2", help="request mix")
+    parser.add_argument("--batch-size", type=int, default=32, help="number of instances in iris-batch requests")
+    parser.add_argument("--image-sizes", default="224,1024", help="sizes of the flowers-<size> images")
+    parser.add_argument("--iris-framework", choices=list(IRIS_MODELS), default="sklearn")
+    parser.add_argument("--stub-flowers", action="store_true", help="serve a small untrained flowers model")
+    parser.add_argument("--workers", default="", help="comma separated list of workers, runs the production mode")
+    parser.add_argument("--pin-cpus", action="store_true", help="pin the workers to their cpus")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--compare", action="store_true", help="compare with the last run with the same config")
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    image_sizes = [int(size) for size in args.image_sizes.split(",")]
+    scenarios = build_scenarios(args.batch_size, image_sizes, args.seed)
+    unknown = set(weights) - set(scenarios)
+    if unknown:
+        parser.error(f"unknown scenarios in --mix: {unknown}, available: {list(scenarios)}")
+    stub_flowers = args.stub_flowers
+    if not stub_flowers and not (BACKEND_FOLDER / os.environ.get("FLOWERS_MODEL_PATH", FLOWERS_MODEL)).exists():
+        # the API loads all the models when it starts
+        print("the trained flowers model is missing, serving a stub flowers model")
+        stub_flowers = True
+    config = {
+        "mix": weights,
+        "batch_size": args.batch_size,
+        "requests": args.requests,
+        "iris_framework": args.iris_framework,
+        "stub_flowers": stub_flowers,
+        "workers": args.workers,
+        "pin_cpus": args.pin_cpus,
+        "cpus": os.cpu_count(),
+    }
+    worker_counts = [int(w) for w in args.workers.split(",")] if args.workers else [None]
+
+    env = {"IRIS_FRAMEWORK": args.iris_framework, "IRIS_MODEL_PATH": IRIS_MODELS[args.iris_framework]}
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        if stub_flowers:
+            stub_path = Path(tmp_folder) / "flowers-stub.keras"
+            make_stub_flowers_model(stub_path)
+            env["FLOWERS_MODEL_PATH"] = str(stub_path)
+
+        runs = []
+        memory = {}
+        for workers in worker_counts:
+            server = Server(args.port, env, workers=workers, pin_cpus=args.pin_cpus)
+            server.start()
+            try:
+                if args.warmup:
+                    run_load(args.port, scenarios, weights, min(4, args.warmup), args.warmup, args.seed)
+                for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                    server.reset_peak_rss()
+                    run = run_load(args.port, scenarios, weights, concurrency, args.requests, args.seed)
+                    runs.append({"workers": workers, **run, "peak_rss_mb": server.peak_rss_mb()})
+                memory[str(workers)] = server.memory_usage()
+            finally:
+                server.stop()
+
+    previous = load_previous(config) if args.compare else {}
+    for run in runs:
+        print_run(run, previous.get((run["workers"], run["concurrency"])))
+    if args.workers:
+        print("scaling with the number of workers, at the highest concurrency:")
+        max_concurrency = max(run["concurrency"] for run in runs)
+        for run in runs:
+            if run["concurrency"] == max_concurrency:
+                usage = memory[str(run["workers"])] or {}
+                print(
+                    f"    workers {run['workers']:>2}: {run['throughput_rps']:>8.1f} req/s  "
+                    f"PSS per worker {usage.get('pss_mb_per_worker', float('nan')):>7.1f}MB  "
+                    f"total PSS {usage.get('pss_mb', float('nan')):>7.1f}MB  total RSS {usage.get('rss_mb', float('nan')):>7.1f}MB"
+                )
+
+    if not args.no_save:
+        commit = git_commit()
+        result = {
+            "commit": commit,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "config": config,
+            "memory": memory,
+            "runs": runs,
+        }
+        RESULTS_FOLDER.mkdir(exist_ok=True)
+        path = RESULTS_FOLDER / f"{datetime.now():%Y%m%d-%H%M%S}-{commit}.json"
+        path.write_text(json.dumps(result, indent=2))
+        print(f"results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
 import uvicorn  # web server
+import argparse
 import os
 
 if __name__ == "__main__":
-    # we just call the run method to start the API
-    uvicorn.run(
-        "api:app", host="0.0.0.0", reload=True, port=int(os.environ.get("PORT", 8080))
-    )
+    parser = argparse.ArgumentParser(description="Start the models API.")
+    parser.add_argument("--prod", action="store_true", help="production mode, several worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="number of workers, one per cpu by default")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="cpus / workers by default")
+    parser.add_argument("--pin-cpus", action="store_true", help="pin each worker to its own cpus (Linux only)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    args = parser.parse_args()
+
+    if args.prod:
+        import prefork
+
+        prefork.run(
+            host="0.0.0.0",
+            port=args.port,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            pin_cpus=args.pin_cpus,
+        )
+    else:
+        # we just call the run method to start the API
+        uvicorn.run("api:app", host="0.0.0.0", reload=True, port=args.port)
@@ -0,0 +1,293 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import traceback
+import typing
+from bisect import bisect_left
+
+# latency buckets in seconds, from 0.5ms to 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Timer:
+    """
+    Context manager measuring the time spent in a block and recording it in a histogram.
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "HistogramChild"):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class HistogramChild:
+    """
+    Histogram for a single combination of label values.
+    """
+
+    def __init__(self, buckets: typing.Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+
+class Histogram:
+    """
+    Minimal Prometheus style histogram with labels, cheap enough to stay on in production:
+    an observation is a bisect and three increments under a lock.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: typing.Sequence[str] = (),
+        buckets: typing.Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._children: typing.Dict[typing.Tuple[str, ...], HistogramChild] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> HistogramChild:
+        """
+        Get the histogram for the given label values, in the same order as label_names.
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError(f"Expected labels {self.label_names}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, HistogramChild(self.buckets))
+        return child
+
+    def collect(self) -> typing.Dict[typing.Tuple[str, ...], typing.Tuple[typing.List[int], float, int]]:
+        """
+        Current state of the histogram: label values -> (bucket counts, sum, count).
+        """
+        samples = {}
+        for values, child in list(self._children.items()):
+            with child._lock:
+                samples[values] = (list(child.counts), child.sum, child.count)
+        return samples
+
+    def render(self, samples: dict = None) -> typing.List[str]:
+        """
+        Render the histogram in the Prometheus text format.
+        :param samples: state to render, as returned by collect, the state of this process by default
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        samples = self.collect() if samples is None else samples
+        for values, (counts, total, count) in samples.items():
+            labels = [f'{name}="{value}"' for name, value in zip(self.label_names, values)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of the metrics exposed by the /metrics endpoint.
+
+    With several worker processes (prefork.py), each worker has its own metrics: set
+    multiprocess_dir to a folder shared by the workers, each of them saves its state there
+    (flush, every flush_interval seconds with start_flusher) and render merges all of them.
+    The files of dead workers are kept, so the counts never go down.
+    """
+
+    def __init__(self, multiprocess_dir: typing.Optional[str] = None, flush_interval: float = 1.0):
+        self._metrics: typing.Dict[str, Histogram] = {}
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._flusher: typing.Optional[threading.Thread] = None
+        # the flusher thread and the /metrics requests write the same file
+        self._flush_lock = threading.Lock()
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        label_names: typing.Sequence[str] = (),
+        buckets: typing.Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, description, label_names, buckets)
+        return self._metrics[name]
+
+    def flush(self):
+        """
+        Save the state of this process in multiprocess_dir.
+        """
+        state = {
+            name: [[list(values), counts, total, count] for values, (counts, total, count) in metric.collect().items()]
+            for name, metric in self._metrics.items()
+        }
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        # written to a temporary file then renamed, so readers never see a partial file
+        with self._flush_lock:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{path}.tmp", path)
+
+    def start_flusher(self):
+        """
+        Flush periodically in a background thread, call it in each worker after the fork.
+        """
+        if self.multiprocess_dir is None or (self._flusher is not None and self._flusher.is_alive()):
+            return
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    # keep flushing, e.g. after a temporary disk error
+                    traceback.print_exc()
+
+        self._flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def _merge(self) -> typing.Dict[str, dict]:
+        """
+        Sum the states saved by all the processes.
+        """
+        self.flush()
+        merged: typing.Dict[str, dict] = {name: {} for name in self._metrics}
+        for file_name in os.listdir(self.multiprocess_dir):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.multiprocess_dir, file_name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, children in state.items():
+                if name not in merged:
+                    continue
+                for values, counts, total, count in children:
+                    key = tuple(values)
+                    if key in merged[name]:
+                        previous_counts, previous_total, previous_count = merged[name][key]
+                        counts = [a + b for a, b in zip(previous_counts, counts)]
+                        total, count = previous_total + total, previous_count + count
+                    merged[name][key] = (counts, total, count)
+        return merged
+
+    def render(self) -> str:
+        merged = self._merge() if self.multiprocess_dir is not None else {}
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.extend(metric.render(merged.get(name)))
+        return "\n".join(lines) + "\n"
+
+
+class TraceRecorder:
+    """
+    Record the raw service time of each prediction, per model and batch size, as JSON lines:
+        {"time": 1718000000.0, "model": "iris-model", "batch_size": 32, "service_s": 0.0012}
+    The histograms only keep bucket counts, the capacity planning simulator
+    (data-managment/capacity_planning.py) resamples these traces. Disabled when path is None.
+    Each process appends to the file on its own, the lines are short enough to be written atomically.
+    """
+
+    def __init__(self, path: typing.Optional[str] = None):
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(self, model: str, batch_size: int, seconds: float):
+        line = json.dumps({"time": time.time(), "model": model, "batch_size": batch_size, "service_s": seconds})
+        with self._lock:
+            # opened lazily, and again in forked workers
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.path, "a", buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line + "\n")
+
+    def time(self, model: str, batch_size: int) -> typing.ContextManager:
+        """
+        Time a prediction, e.g.
+            with TRACES.time("iris-model", len(X)):
+                predictions = model.predict(X)
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return Timer(_TraceObserver(self, model, batch_size))
+
+
+class _TraceObserver:
+    __slots__ = ("recorder", "model", "batch_size")
+
+    def __init__(self, recorder: TraceRecorder, model: str, batch_size: int):
+        self.recorder = recorder
+        self.model = model
+        self.batch_size = batch_size
+
+    def observe(self, value: float):
+        self.recorder.record(self.model, self.batch_size, value)
+
+
+# set by prefork.py when the API runs with several worker processes
+REGISTRY = MetricsRegistry(os.environ.get("METRICS_MULTIPROC_DIR") or None)
+
+# time spent in each stage of a prediction: parse, preprocess, forward, postprocess, serialize
+STAGE_LATENCY = REGISTRY.histogram(
+    "model_stage_latency_seconds",
+    "Latency of each stage of a prediction request.",
+    ["model", "stage"],
+)
+REQUEST_LATENCY = REGISTRY.histogram(
+    "http_request_latency_seconds",
+    "Latency of the HTTP requests.",
+    ["method", "path", "status"],
+)
+
+
+def stage_timer(model: str, stage: str) -> Timer:
+    """
+    Time a stage of a prediction, e.g.
+        with stage_timer("iris-model", "forward"):
+            predictions = model.predict(X)
+    """
+    return STAGE_LATENCY.labels(model, stage).time()
+
+
+# service time traces, recorded when LATENCY_TRACE_PATH is set
+TRACES = TraceRecorder(os.environ.get("LATENCY_TRACE_PATH") or None)
@@ -1,4 +1,7 @@
 import numpy as np
+import hashlib
+import json
+import threading
 from enum import Enum, auto
 from pathlib import Path
 import typing
@@ -8,6 +11,7 @@ import tensorflow as tf
 from PIL import Image as PILImage
 from io import BytesIO
 import keras
+from metrics import stage_timer
 
 
 class Framework(Enum):
@@ -16,6 +20,66 @@ class Framework(Enum):
     PYTORCH = auto()
 
 
+# quantized variants of the keras models, produced by quantize.py
+VARIANTS = ("float16", "int8")
+VARIANTS_MANIFEST = "variants.json"
+
+
+def variant_path(model_path: typing.Union[str, Path], variant: str) -> Path:
+    """
+    Path of a quantized variant, saved next to the keras model, e.g. model.int8.tflite
+    """
+    model_path = Path(model_path)
+    return model_path.with_name(f"{model_path.stem}.{variant}.tflite")
+
+
+def file_sha256(path: typing.Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_variants_manifest(model_path: typing.Union[str, Path]) -> dict:
+    """
+    Variants published for a model, with their accuracy and performance report.
+    """
+    manifest_path = Path(model_path).with_name(VARIANTS_MANIFEST)
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text())
+
+
+class TFLiteModel:
+    """
+    TensorFlow Lite model with the same predict interface as a keras model.
+    """
+
+    def __init__(self, model_path: typing.Union[str, Path]):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=str(model_path))
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        # the interpreter is stateful, a single inference at a time
+        self._lock = threading.Lock()
+
+    def predict(self, X: typing.Any, **kwargs) -> np.ndarray:
+        X = np.asarray(X, dtype=self.input_details["dtype"])
+        with self._lock:
+            if self._batch_size != X.shape[0]:
+                self.interpreter.resize_tensor_input(self.input_details["index"], X.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = X.shape[0]
+            self.interpreter.set_tensor(self.input_details["index"], X)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_details["index"]).copy()
+
+
 class Model(ABC):
     def __init__(
         self,
@@ -23,14 +87,17 @@ class Model(ABC):
         model_path: typing.Union[str, Path],
         framework: Framework,
         classes: typing.List[str],
+        variant: typing.Optional[str] = None,
     ):
         """
         Abstract base model class to handle loading and predicting using different frameworks.
+        variant selects a quantized version of a TensorFlow model, e.g. "int8" or "float16".
         """
         self.model_name = model_name
         self.model_path = Path(model_path)
         self.framework = framework
         self.classes = classes
+        self.variant = variant
         self.model = None
         self.load()
 
@@ -43,7 +110,9 @@ class Model(ABC):
         if not self.model_path.exists():
             raise ValueError(f"Model file {self.model_path} not found.")
 
-        if self.framework == Framework.SKLEARN:
+        if self.variant is not None:
+            self._load_variant()
+        elif self.framework == Framework.SKLEARN:
             self._load_sklearn_model()
         elif self.framework == Framework.TENSORFLOW:
             self._load_tensorflow_model()
@@ -65,6 +134,22 @@ class Model(ABC):
         except Exception as e:
             raise ValueError(f"Error loading TensorFlow model")
 
+    def _load_variant(self):
+        """
+        Load a quantized variant of a TensorFlow model. Only variants that passed the
+        accuracy gate of quantize.py, for the current version of the model, can be loaded.
+        """
+        if self.framework != Framework.TENSORFLOW:
+            raise ValueError(f"Variants are not supported for {self.framework}.")
+        manifest = load_variants_manifest(self.model_path)
+        if self.variant not in manifest:
+            raise ValueError(f"Variant {self.variant} of {self.model_path} was not published.")
+        if manifest[self.variant]["source_sha256"] != file_sha256(self.model_path):
+            raise ValueError(
+                f"Variant {self.variant} was built from another version of {self.model_path}, run quantize.py again."
+            )
+        self.model = TFLiteModel(variant_path(self.model_path, self.variant))
+
     @abstractmethod
     def predict(self, X: typing.Any) -> typing.Any:
         """
@@ -84,12 +169,13 @@ class IrisModel(Model):
         self,
         framework: Framework = Framework.TENSORFLOW,
         model_path: typing.Union[str, Path] = None,
+        variant: typing.Optional[str] = None,
     ):
         """
         Initialize an Iris model, supporting both TensorFlow and sklearn frameworks.
         """
         classes = ["setosa", "versicolor", "virginica"]
-        super().__init__("iris-model", model_path, framework, classes)
+        super().__init__("iris-model", model_path, framework, classes, variant)
 
     def predict(self, X: np.ndarray) -> typing.List[dict]:
         """
@@ -99,19 +185,21 @@ class IrisModel(Model):
         Returns:
             List of dictionaries with class probabilities.
         """
-        if self.framework == Framework.SKLEARN:
-            predictions = self.model.predict_proba(X)
-        elif self.framework == Framework.TENSORFLOW:
-            predictions = self.model.predict(X)
-        else:
-            raise ValueError(
-                f"Framework {self.framework} not supported for prediction."
-            )
+        with stage_timer(self.model_name, "forward"):
+            if self.framework == Framework.SKLEARN:
+                predictions = self.model.predict_proba(X)
+            elif self.framework == Framework.TENSORFLOW:
+                predictions = self.model.predict(X)
+            else:
+                raise ValueError(
+                    f"Framework {self.framework} not supported for prediction."
+                )
 
-        outputs = [
-            {self.classes[j]: round(float(prob), 3) for j, prob in enumerate(xi_probs)}
-            for xi_probs in predictions
-        ]
+        with stage_timer(self.model_name, "postprocess"):
+            outputs = [
+                {self.classes[j]: round(float(prob), 3) for j, prob in enumerate(xi_probs)}
+                for xi_probs in predictions
+            ]
         return outputs
 
 
@@ -120,12 +208,13 @@ class FlowersModel(Model):
         self,
         framework: Framework = Framework.TENSORFLOW,
         model_path: typing.Union[str, Path] = None,
+        variant: typing.Optional[str] = None,
     ):
         """
         Initialize a TensorFlow-based Flowers model.
         """
         classes = ["daisy", "dandelion", "roses", "sunflowers", "tulips"]
-        super().__init__("flowers-model", model_path, Framework.TENSORFLOW, classes)
+        super().__init__("flowers-model", model_path, Framework.TENSORFLOW, classes, variant)
         self.target_size = (180, 180)
 
     def _preprocess_image(self, image_bytes: bytes) -> tf.Tensor:
@@ -153,12 +242,24 @@ class FlowersModel(Model):
         Returns:
             List of dictionaries with class probabilities.
         """
-        img_tensor = self._preprocess_image(image_bytes)
-        scores = self.model.predict(img_tensor)
-        predictions = tf.nn.softmax(scores)
+        return self.predict_batch([image_bytes])
 
-        outputs = [
-            {self.classes[j]: round(float(prob), 3) for j, prob in enumerate(xi_probs)}
-            for xi_probs in predictions
-        ]
+    def predict_batch(self, images: typing.List[bytes]) -> typing.List[dict]:
+        """
+        Make predictions on several images in a single forward pass.
+        Args:
+            images: Raw image data in bytes, one per image.
+        Returns:
+            List of dictionaries with class probabilities, one per image.
+        """
+        with stage_timer(self.model_name, "preprocess"):
+            img_tensor = tf.concat([self._preprocess_image(image_bytes) for image_bytes in images], axis=0)
+        with stage_timer(self.model_name, "forward"):
+            scores = self.model.predict(img_tensor)
+        with stage_timer(self.model_name, "postprocess"):
+            predictions = tf.nn.softmax(scores)
+            outputs = [
+                {self.classes[j]: round(float(prob), 3) for j, prob in enumerate(xi_probs)}
+                for xi_probs in predictions
+            ]
         return outputs
@@ -0,0 +1,196 @@
+"""
+Production server: a parent process loads the libraries and the models once, then forks
+N uvicorn workers sharing the listening socket. Pages loaded before the fork (TensorFlow,
+numpy and sklearn code, sklearn models) are shared copy-on-write by all the workers.
+Workers that die are restarted with a growing delay, the server stops with a non-zero exit code
+if a worker fails to start or keeps crashing.
+
+Each worker has its own metrics and profiler: the workers save their metrics in a shared folder
+(METRICS_MULTIPROC_DIR, a temporary folder by default) so /metrics returns the totals of all the
+workers, the runtime profiler (/profiler/*) is disabled with several workers, profile a single
+worker with python main.py instead.
+"""
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+import typing
+
+# variables read by the BLAS/OpenMP libraries and TensorFlow when they are loaded
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+)
+# exit code of a worker that failed to start (same as uvicorn), e.g. a model failed to load
+WORKER_STARTUP_FAILURE = 3
+# a worker dying sooner than this after its start counts as a crash loop
+MIN_WORKER_UPTIME = 30.0
+MAX_RESTART_DELAY = 30.0
+# consecutive crashes of a worker before giving up
+MAX_CRASHES = 5
+
+
+def available_cpus() -> typing.List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def configure_threads(num_threads: int):
+    """
+    Limit the threads used by each worker, so N workers don't oversubscribe the cores.
+    Must be called before numpy or TensorFlow are imported.
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    # the inter-op pool runs independent ops in parallel, one thread is enough to serve single requests
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+
+def worker_cpus(worker_id: int, threads_per_worker: int) -> typing.Set[int]:
+    """
+    CPUs a worker is pinned to, consecutive blocks of threads_per_worker cpus.
+    """
+    cpus = available_cpus()
+    start = (worker_id * threads_per_worker) % len(cpus)
+    return {cpus[(start + i) % len(cpus)] for i in range(threads_per_worker)}
+
+
+def run_worker(app, sock: socket.socket, worker_id: int, threads_per_worker: int, pin_cpus: bool) -> int:
+    """
+    Serve the API in the worker process until it is stopped.
+    :return: exit code of the worker
+    """
+    import uvicorn
+
+    if pin_cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, worker_cpus(worker_id, threads_per_worker))
+        else:
+            print("CPU pinning is not supported on this platform.")
+    config = uvicorn.Config(app, log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+    return 0 if server.started else WORKER_STARTUP_FAILURE
+
+
+def run(
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    workers: int = None,
+    threads_per_worker: int = None,
+    pin_cpus: bool = False,
+):
+    """
+    Start the API with several worker processes.
+    :param host: address to listen on
+    :param port: port to listen on
+    :param workers: number of worker processes, one per cpu by default
+    :param threads_per_worker: threads used by each worker for BLAS and TensorFlow, cpus / workers by default
+    :param pin_cpus: pin each worker to its own set of cpus (Linux only)
+    """
+    num_cpus = len(available_cpus())
+    workers = workers or num_cpus
+    threads_per_worker = threads_per_worker or max(1, num_cpus // workers)
+    configure_threads(threads_per_worker)
+    # read by metrics.py and api.py when they are imported
+    os.environ["PREFORK_WORKERS"] = str(workers)
+    metrics_dir = None
+    if workers > 1 and not os.environ.get("METRICS_MULTIPROC_DIR"):
+        metrics_dir = tempfile.mkdtemp(prefix="api-metrics-")
+        os.environ["METRICS_MULTIPROC_DIR"] = metrics_dir
+
+    # imported after configure_threads, the libraries read the thread settings when they are loaded
+    import api
+
+    api.preload_models()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    print(f"api listening on {host}:{port} with {workers} workers, {threads_per_worker} threads per worker")
+
+    children: typing.Dict[int, int] = {}  # pid -> worker id
+    started_at: typing.Dict[int, float] = {}  # worker id -> start time
+    crashes: typing.Dict[int, int] = {}  # worker id -> consecutive crashes
+    shutting_down = False
+    failed = False
+
+    def spawn(worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 1
+            try:
+                code = run_worker(api.app, sock, worker_id, threads_per_worker, pin_cpus)
+            except SystemExit as e:
+                # uvicorn exits with WORKER_STARTUP_FAILURE when the lifespan startup fails
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                # skip the cleanup of the parent's state inherited by the fork
+                os._exit(code)
+        children[pid] = worker_id
+        started_at[worker_id] = time.monotonic()
+
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for worker_id in range(workers):
+        spawn(worker_id)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is None or shutting_down:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if code == WORKER_STARTUP_FAILURE:
+            # restarting won't help, e.g. a model is missing
+            print(f"worker {worker_id} (pid {pid}) failed to start, stopping the server")
+            failed = True
+            shutdown(None, None)
+            continue
+        # a worker died (e.g. out of memory), replace it, with a growing delay if it keeps crashing
+        quick_crash = time.monotonic() - started_at[worker_id] < MIN_WORKER_UPTIME
+        crashes[worker_id] = crashes.get(worker_id, 0) + 1 if quick_crash else 1
+        if crashes[worker_id] > MAX_CRASHES:
+            print(f"worker {worker_id} crashed {MAX_CRASHES} times in a row, stopping the server")
+            failed = True
+            shutdown(None, None)
+            continue
+        delay = min(MAX_RESTART_DELAY, 0.5 * 2 ** (crashes[worker_id] - 1))
+        print(f"worker {worker_id} (pid {pid}) exited with code {code}, restarting it in {delay:.1f}s")
+        time.sleep(delay)
+        if not shutting_down:
+            spawn(worker_id)
+    sock.close()
+    if metrics_dir is not None:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
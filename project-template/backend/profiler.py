@@ -0,0 +1,110 @@
+import sys
+import threading
+import time
+import typing
+from collections import Counter
+
+# shortest interval between two samples, below that the sampling thread would hog a core
+MIN_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that can be started and stopped at runtime: a background thread
+    samples the stacks of all the other threads every interval seconds. Nothing is
+    instrumented, so the overhead is only the sampling thread while it is running.
+    """
+
+    def __init__(self):
+        self.interval = 0.01
+        self.samples: typing.Counter[str] = Counter()
+        self.num_samples = 0
+        self.started_at: typing.Optional[float] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.01):
+        """
+        Start sampling, previous samples are discarded.
+        :param interval: time in seconds between two samples
+        Raises:
+            ValueError: If interval is shorter than MIN_INTERVAL.
+        """
+        if interval < MIN_INTERVAL:
+            raise ValueError(f"The interval must be at least {MIN_INTERVAL}s.")
+        if self.running:
+            return
+        self.interval = interval
+        with self._lock:
+            self.samples.clear()
+            self.num_samples = 0
+        self.started_at = time.time()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, the samples are kept until the next start.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples.update(stacks)
+                self.num_samples += 1
+
+    def collapsed(self) -> str:
+        """
+        Samples in the collapsed stack format, the input of flamegraph.pl or speedscope.
+        """
+        with self._lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def report(self, limit: int = 20) -> dict:
+        """
+        Summary of the samples, with the functions where most of the time is spent.
+        :param limit: number of functions to return
+        """
+        with self._lock:
+            samples = dict(self.samples)
+            num_samples = self.num_samples
+        # a function is counted once per stack, as the leaf (self time) or anywhere in the stack (total time),
+        # the line numbers are dropped so the samples of all the lines of a function add up
+        self_time: typing.Counter[str] = Counter()
+        total_time: typing.Counter[str] = Counter()
+        for stack, count in samples.items():
+            frames = [frame.rsplit(":", 1)[0] for frame in stack.split(";")]
+            self_time[frames[-1]] += count
+            for function in set(frames):
+                total_time[function] += count
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "num_samples": num_samples,
+            "self": [{"function": f, "samples": c} for f, c in self_time.most_common(limit)],
+            "total": [{"function": f, "samples": c} for f, c in total_time.most_common(limit)],
+        }
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,202 @@
+"""
+Post-training quantization of the keras models.
+
+Converts a keras model into float16 and int8 TensorFlow Lite variants, evaluates them on a
+held-out set and publishes (saves next to the model and registers in variants.json) only the
+variants whose accuracy doesn't drop more than --max-accuracy-drop from the float32 model.
+Prints a report with the accuracy, latency, throughput and size of each variant.
+
+Usage:
+    python quantize.py iris
+    python quantize.py flowers --variants int8 --max-accuracy-drop 0.02
+
+The published variants are served by setting IRIS_VARIANT / FLOWERS_VARIANT, e.g.
+    IRIS_FRAMEWORK=tensorflow IRIS_MODEL_PATH=./../models/iris-model/keras/model.keras IRIS_VARIANT=int8 python main.py
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+from models import (
+    VARIANTS,
+    VARIANTS_MANIFEST,
+    FlowersModel,
+    Framework,
+    IrisModel,
+    TFLiteModel,
+    file_sha256,
+    load_variants_manifest,
+    variant_path,
+)
+
+MODEL_PATHS = {
+    "iris": "./../models/iris-model/keras/model.keras",
+    "flowers": "./../models/flowers-model/model.keras",
+}
+
+Dataset = typing.Tuple[np.ndarray, np.ndarray]
+
+
+def load_iris_data() -> typing.Tuple[Dataset, Dataset]:
+    """
+    Calibration and held-out sets, the same split as in iris_train.ipynb.
+    """
+    from sklearn.datasets import load_iris
+    from sklearn.model_selection import train_test_split
+
+    iris = load_iris()
+    X_train, X_test, y_train, y_test = train_test_split(
+        iris.data, iris.target, test_size=0.2, random_state=42, stratify=iris.target
+    )
+    return (X_train.astype(np.float32), y_train), (X_test.astype(np.float32), y_test)
+
+
+def load_flowers_data(image_size: int = 180, num_calibration: int = 200) -> typing.Tuple[Dataset, Dataset]:
+    """
+    Calibration and held-out sets, the same splits as in flowers_model.ipynb (train and test).
+    """
+    try:
+        import tensorflow_datasets as tfds
+    except ImportError:
+        raise ImportError(
+            "tensorflow-datasets is needed to quantize the flowers model, install it with pip install tensorflow-datasets"
+        ) from None
+
+    ds_train, ds_test = tfds.load("tf_flowers", split=["train[:80%]", "train[90%:]"], as_supervised=True)
+
+    def to_numpy(ds, limit=None):
+        ds = ds.map(lambda x, y: (tf.image.resize(x, (image_size, image_size)) / 255.0, y))
+        if limit is not None:
+            ds = ds.take(limit)
+        images, labels = zip(*tfds.as_numpy(ds))
+        return np.stack(images).astype(np.float32), np.array(labels)
+
+    return to_numpy(ds_train.shuffle(1000, seed=42), num_calibration), to_numpy(ds_test)
+
+
+def convert(keras_model, variant: str, calibration_data: np.ndarray) -> bytes:
+    """
+    Convert a keras model to a quantized TensorFlow Lite model.
+    :param keras_model: the float32 model
+    :param variant: float16 (weights in float16) or int8 (weights and activations in int8, float inputs and outputs)
+    :param calibration_data: samples used to calibrate the int8 activation ranges
+    :return: the TensorFlow Lite model
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == "int8":
+        converter.representative_dataset = lambda: ([sample[None]] for sample in calibration_data)
+    else:
+        raise ValueError(f"Variant {variant} is not supported, use one of {VARIANTS}.")
+    return converter.convert()
+
+
+def accuracy(model, data: Dataset, batch_size: int = 32) -> float:
+    X, y = data
+    predictions = np.concatenate(
+        [model.predict(X[i: i + batch_size], verbose=0) for i in range(0, len(X), batch_size)]
+    )
+    return float(np.mean(np.argmax(predictions, axis=1) == y))
+
+
+def performance(model, X: np.ndarray, runs: int = 50, batch_size: int = 32) -> dict:
+    """
+    Median latency of a single sample prediction and throughput with batches, through the
+    predict method used by the API.
+    """
+    sample, batch = X[:1], X[:batch_size]
+    model.predict(sample, verbose=0)  # warmup
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model.predict(sample, verbose=0)
+        latencies.append(time.perf_counter() - start)
+    model.predict(batch, verbose=0)
+    start = time.perf_counter()
+    for _ in range(max(1, runs // 5)):
+        model.predict(batch, verbose=0)
+    elapsed = time.perf_counter() - start
+    return {
+        "latency_ms": round(float(np.median(latencies)) * 1000, 3),
+        "throughput": round(max(1, runs // 5) * len(batch) / elapsed, 1),
+    }
+
+
+def print_report(report: typing.Dict[str, dict]):
+    print(f"{'variant':<10}{'accuracy':>10}{'drop':>8}{'latency':>12}{'throughput':>14}{'size':>12}  status")
+    for name, row in report.items():
+        print(
+            f"{name:<10}{row['accuracy']:>10.4f}{row['accuracy_drop']:>8.4f}{row['latency_ms']:>10.3f}ms"
+            f"{row['throughput']:>12.1f}/s{row['size_bytes'] / 1024:>10.1f}KB  {row['status']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the keras models.")
+    parser.add_argument("model", choices=list(MODEL_PATHS))
+    parser.add_argument("--model-path", default=None, help="path of the keras model")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="comma separated list of variants")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01, help="max accuracy drop allowed")
+    args = parser.parse_args()
+
+    model_path = Path(args.model_path or MODEL_PATHS[args.model])
+    if args.model == "iris":
+        base_model = IrisModel(framework=Framework.TENSORFLOW, model_path=model_path)
+        calibration, held_out = load_iris_data()
+    else:
+        base_model = FlowersModel(framework=Framework.TENSORFLOW, model_path=model_path)
+        calibration, held_out = load_flowers_data(image_size=base_model.target_size[0])
+
+    baseline_accuracy = accuracy(base_model.model, held_out)
+    report = {
+        "float32": {
+            "accuracy": baseline_accuracy,
+            "accuracy_drop": 0.0,
+            "size_bytes": model_path.stat().st_size,
+            **performance(base_model.model, held_out[0]),
+            "status": "baseline",
+        }
+    }
+
+    manifest = load_variants_manifest(model_path)
+    source_sha256 = file_sha256(model_path)
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        for variant in args.variants.split(","):
+            candidate_path = Path(tmp_folder) / variant_path(model_path, variant).name
+            candidate_path.write_bytes(convert(base_model.model, variant, calibration[0]))
+            candidate = TFLiteModel(candidate_path)
+            variant_accuracy = accuracy(candidate, held_out)
+            row = {
+                "accuracy": variant_accuracy,
+                "accuracy_drop": round(baseline_accuracy - variant_accuracy, 4),
+                "size_bytes": candidate_path.stat().st_size,
+                **performance(candidate, held_out[0]),
+            }
+            if row["accuracy_drop"] > args.max_accuracy_drop:
+                row["status"] = "rejected"
+            else:
+                row["status"] = "published"
+                shutil.move(candidate_path, variant_path(model_path, variant))
+                manifest[variant] = {
+                    **{key: value for key, value in row.items() if key != "status"},
+                    "baseline_accuracy": baseline_accuracy,
+                    "held_out_samples": len(held_out[1]),
+                    "source_sha256": source_sha256,
+                }
+            report[variant] = row
+
+    model_path.with_name(VARIANTS_MANIFEST).write_text(json.dumps(manifest, indent=2))
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Record service time traces of the models, per batch size, for the capacity planning simulator
+(data-managment/capacity_planning.py).
+
+Times the predict methods used by the API in this process, without HTTP, so the traces only
+contain the time spent by a worker on a batch. Run it on the hardware and with the threads per
+worker of the deployment, e.g. with OMP_NUM_THREADS / TF_NUM_INTRAOP_THREADS set like prefork.py.
+The API can also record traces of the real traffic with LATENCY_TRACE_PATH=traces/api.jsonl.
+
+Usage:
+    python record_traces.py iris --batch-sizes 1,2,4,8,16,32,64 --runs 200
+    python record_traces.py flowers --stub-flowers --batch-sizes 1,2,4,8 --output traces/flowers.jsonl
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmark import IRIS_MODELS, make_iris_instance, make_jpeg, make_stub_flowers_model
+from metrics import TraceRecorder
+
+TRACES_FOLDER = Path(__file__).resolve().parent / "traces"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record service time traces of the models.")
+    parser.add_argument("model", choices=["iris", "flowers"])
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16,32", help="comma separated list of batch sizes")
+    parser.add_argument("--runs", type=int, default=100, help="number of predictions per batch size")
+    parser.add_argument("--warmup", type=int, default=5, help="predictions per batch size not recorded")
+    parser.add_argument("--iris-framework", choices=list(IRIS_MODELS), default="sklearn")
+    parser.add_argument("--image-size", type=int, default=224, help="size of the images sent to the flowers model")
+    parser.add_argument("--stub-flowers", action="store_true", help="use a small untrained flowers model")
+    parser.add_argument("--output", default=None, help="traces file, traces/<model>.jsonl by default")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    output = Path(args.output) if args.output else TRACES_FOLDER / f"{args.model}.jsonl"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    recorder = TraceRecorder(str(output))
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        # the api reads the model paths when it is imported
+        os.environ.setdefault("IRIS_FRAMEWORK", args.iris_framework)
+        os.environ.setdefault("IRIS_MODEL_PATH", IRIS_MODELS[args.iris_framework])
+        if args.stub_flowers:
+            stub_path = Path(tmp_folder) / "flowers-stub.keras"
+            make_stub_flowers_model(stub_path)
+            os.environ["FLOWERS_MODEL_PATH"] = str(stub_path)
+        import api
+
+        model = api.create_model(args.model)
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            if args.model == "iris":
+                instances = [make_iris_instance(rng) for _ in range(batch_size)]
+                batch = np.array([list(instance.values()) for instance in instances])
+                predict = lambda: model.predict(batch)
+            else:
+                images = [make_jpeg(args.image_size, seed=args.seed + i) for i in range(batch_size)]
+                predict = lambda: model.predict_batch(images)
+            for _ in range(args.warmup):
+                predict()
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                with recorder.time(model.model_name, batch_size):
+                    predict()
+            elapsed = time.perf_counter() - start
+            print(f"{model.model_name} batch size {batch_size:>4}: {elapsed / args.runs * 1000:>8.2f}ms per batch")
+    print(f"traces appended to {output}")
+
+
+if __name__ == "__main__":
+    main()